@@ -18,15 +18,21 @@
 # - script migration to Tensorflow 2.x version
 # - main function and unused imports have been removed
 # - updated synth_train_fn function for stable CPU and HPU results
-# - enabled experimental.prefetch_to_device functionality to improve the performance
+# - enabled experimental.prefetch_to_device functionality to improve the performance (HPU and GPU)
+# - Cast, NormalizeImages and RandomBrightnessCorrection replaced with FusedNormalizeCastBrightness
+# - parallel transform map stages are non-deterministic unless deterministic_data is set
+# - training records are cached after parsing
+# - labels are kept sparse in the input pipeline and one-hot encoded in the model function
+# - normalized images are emitted in bf16 when training in bf16 on HPU
+# - enabled tf.data map fusion, map parallelization and parallel batch optimizations
 
 import os
 
 import numpy as np
 import tensorflow as tf
 
-from dataset.transforms import NormalizeImages, OneHotLabels, apply_transforms, PadXYZ, RandomCrop3D, \
-    RandomHorizontalFlip, RandomBrightnessCorrection, CenterCrop, apply_test_transforms, Cast
+from dataset.transforms import apply_transforms, PadXYZ, RandomCrop3D, \
+    RandomHorizontalFlip, CenterCrop, apply_test_transforms, Cast, FusedNormalizeCastBrightness
 
 CLASSES = {0: "TumorCore", 1: "PeritumoralEdema", 2: "EnhancingTumor"}
 
@@ -56,6 +62,7 @@ class Dataset:
 
         self._xshape = (240, 240, 155, 4)
         self._yshape = (240, 240, 155)
+        self._input_dtype = tf.bfloat16 if params.dtype == 'bf16' and not params.no_hpu else tf.float32
 
     def parse(self, serialized):
         features = {
@@ -97,8 +104,9 @@ class Dataset:
 
     def prefetch(self, dataset, buffer_size):
         """Dataset prefetching function"""
-        if len(tf.config.list_logical_devices('HPU')) > 0:
-            device = tf.config.list_logical_devices('HPU')[0].name
+        devices = tf.config.list_logical_devices('HPU') or tf.config.list_logical_devices('GPU')
+        if len(devices) > 0:
+            device = devices[0].name
             with tf.device(device):
                 dataset = dataset.apply(tf.data.experimental.prefetch_to_device(device))
         else:
@@ -106,33 +114,44 @@ class Dataset:
 
         return dataset
 
+    def optimize(self, dataset):
+        """Dataset graph optimizations"""
+        options = tf.data.Options()
+        options.experimental_optimization.map_fusion = True
+        options.experimental_optimization.map_parallelization = True
+        options.experimental_optimization.map_and_batch_fusion = True
+        options.experimental_optimization.parallel_batch = True
+        options.experimental_deterministic = self.params.deterministic_data
+
+        return dataset.with_options(options)
+
     def train_fn(self):
         assert len(self._train) > 0, "Training data not found."
 
         ds = tf.data.TFRecordDataset(filenames=self._train)
 
         ds = ds.shard(self._num_hpus, self._hpu_id)
-        ds = ds.cache()
-        ds = ds.shuffle(buffer_size=self._batch_size * 8, seed=self._seed)
-        ds = ds.repeat()
-
         ds = ds.map(self.parse, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
         transforms = [
-            RandomCrop3D((128, 128, 128)),
+            RandomCrop3D((128, 128, 128), input_shape=self._xshape),
             RandomHorizontalFlip() if self.params.augment else None,
-            Cast(dtype=tf.float32),
-            NormalizeImages(),
-            RandomBrightnessCorrection() if self.params.augment else None,
-            OneHotLabels(n_classes=4),
+            FusedNormalizeCastBrightness(dtype=tf.float32, augment=self.params.augment,
+                                         output_dtype=self._input_dtype),
         ]
+        # Every transform starts from a random crop, so only the parsed records can be cached.
+        ds = ds.cache()
+        ds = ds.shuffle(buffer_size=self._batch_size * 8, seed=self._seed)
+        ds = ds.repeat()
 
         ds = ds.map(map_func=lambda x, y, mean, stdev: apply_transforms(x, y, mean, stdev, transforms=transforms),
-                    num_parallel_calls=tf.data.experimental.AUTOTUNE)
+                    num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                    deterministic=self.params.deterministic_data)
 
         ds = ds.batch(batch_size=self._batch_size,
                       drop_remainder=True)
 
+        ds = self.optimize(ds)
         ds = self.prefetch(ds, buffer_size=tf.data.experimental.AUTOTUNE)
 
         return ds
@@ -145,17 +164,18 @@ class Dataset:
         ds = ds.map(self.parse, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
         transforms = [
-            CenterCrop((224, 224, 155)),
-            Cast(dtype=tf.float32),
-            NormalizeImages(),
-            OneHotLabels(n_classes=4),
-            PadXYZ()
+            CenterCrop((224, 224, 155), input_shape=self._xshape),
+            FusedNormalizeCastBrightness(dtype=tf.float32, augment=False, output_dtype=self._input_dtype),
+            # out-of-range label, one-hot encoded to all zeros like the rest of the padding
+            PadXYZ(label_value=4)
         ]
 
         ds = ds.map(map_func=lambda x, y, mean, stdev: apply_transforms(x, y, mean, stdev, transforms=transforms),
-                    num_parallel_calls=tf.data.experimental.AUTOTUNE)
+                    num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                    deterministic=self.params.deterministic_data)
         ds = ds.batch(batch_size=self._batch_size,
                       drop_remainder=False)
+        ds = self.optimize(ds)
         ds = self.prefetch(ds, buffer_size=tf.data.experimental.AUTOTUNE)
 
         return ds
@@ -168,16 +188,17 @@ class Dataset:
         ds = ds.map(self.parse_x, num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
         transforms = [
-            CenterCrop((224, 224, 155)),
-            Cast(dtype=tf.float32),
-            NormalizeImages(),
+            CenterCrop((224, 224, 155), input_shape=self._xshape),
+            FusedNormalizeCastBrightness(dtype=tf.float32, augment=False, output_dtype=self._input_dtype),
             PadXYZ((224, 224, 160))
         ]
 
         ds = ds.map(map_func=lambda x, mean, stdev: apply_test_transforms(x, mean, stdev, transforms=transforms),
-                    num_parallel_calls=tf.data.experimental.AUTOTUNE)
+                    num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                    deterministic=self.params.deterministic_data)
         ds = ds.batch(batch_size=self._batch_size,
                       drop_remainder=drop_remainder)
+        ds = self.optimize(ds)
         ds = self.prefetch(ds, buffer_size=tf.data.experimental.AUTOTUNE)
 
         return ds
@@ -194,12 +215,10 @@ class Dataset:
 
         transforms = [
             Cast(dtype=tf.uint8),
-            RandomCrop3D((128, 128, 128)),
+            RandomCrop3D((128, 128, 128), input_shape=self._xshape),
             RandomHorizontalFlip() if self.params.augment else None,
-            Cast(dtype=tf.float32),
-            NormalizeImages(),
-            RandomBrightnessCorrection() if self.params.augment else None,
-            OneHotLabels(n_classes=4),
+            FusedNormalizeCastBrightness(dtype=tf.float32, augment=self.params.augment,
+                                         output_dtype=self._input_dtype),
         ]
 
         ds = ds.map(map_func=lambda x, y: apply_transforms(x, y, mean=0.0, stdev=1.0, transforms=transforms),
@@ -17,7 +17,10 @@
 # Changes:
 # - script migration to Tensorflow 2.x version
 # - added seed setting possibility to random operations
+# - transform pipelines are traced into a single tf.function with a static input signature
+# - random values of a whole transform pipeline are drawn with a single op
 
+import numpy as np
 import tensorflow as tf
 
 from runtime.arguments import parse_args
@@ -25,68 +28,129 @@ from runtime.arguments import parse_args
 params = parse_args()
 
 
+def _traced_pipeline(fn, *tensors):
+    """Returns `fn` wrapped in a tf.function with the static input signature of `tensors`."""
+    # Transforms index volumes as channels-last [D, H, W, C]; a static signature keeps that layout
+    # fixed for the whole traced graph instead of letting shapes and layouts be inferred per op.
+    if tensors[0].shape.rank != 4 or not tensors[0].shape.is_fully_defined():
+        raise ValueError("Expected a static [D, H, W, C] volume, got shape: {}".format(tensors[0].shape))
+    signature = tuple(tf.TensorSpec(t.shape, t.dtype) for t in tensors)
+    return tf.function(fn, input_signature=signature)
+
+
+class RandomPool:
+    """Uniform [0, 1) samples for every random transform of a pipeline, drawn with a single op."""
+
+    def __init__(self, x, transforms):
+        size = sum(_t.num_randoms(x) for _t in transforms if hasattr(_t, 'num_randoms'))
+        self._randoms = tf.random.uniform([size], seed=params.seed) if size > 0 else None
+        self._offset = 0
+
+    def take(self, n):
+        if n == 0:
+            # Nothing was drawn when no transform of the pipeline needs random values.
+            return tf.zeros([0])
+        randoms = self._randoms[self._offset:self._offset + n]
+        self._offset += n
+        return randoms
+
+
+def _scale(randoms, minval, maxval):
+    return randoms * (maxval - minval) + minval
+
+
 def apply_transforms(x, y, mean, stdev, transforms):
-    for _t in transforms:
-        if _t is not None:
-            x, y = _t(x, y, mean, stdev)
-    return x, y
+    """Applies transforms as one traced graph; their __call__ methods only run while tracing."""
+    def _apply_transforms(x, y, mean, stdev):
+        pool = RandomPool(x, transforms)
+        for _t in transforms:
+            if _t is None:
+                continue
+            if hasattr(_t, 'num_randoms'):
+                x, y = _t(x, y, mean, stdev, randoms=pool.take(_t.num_randoms(x)))
+            else:
+                x, y = _t(x, y, mean, stdev)
+        return x, y
+
+    mean = tf.convert_to_tensor(mean, dtype=tf.float32)
+    stdev = tf.convert_to_tensor(stdev, dtype=tf.float32)
+    return _traced_pipeline(_apply_transforms, x, y, mean, stdev)(x, y, mean, stdev)
 
 
 def apply_test_transforms(x, mean, stdev, transforms):
-    for _t in transforms:
-        if _t is not None:
-            x = _t(x, y=None, mean=mean, stdev=stdev)
-    return x
+    def _apply_test_transforms(x, mean, stdev):
+        pool = RandomPool(x, transforms)
+        for _t in transforms:
+            if _t is None:
+                continue
+            if hasattr(_t, 'num_randoms'):
+                x = _t(x, y=None, mean=mean, stdev=stdev, randoms=pool.take(_t.num_randoms(x)))
+            else:
+                x = _t(x, y=None, mean=mean, stdev=stdev)
+        return x
+
+    mean = tf.convert_to_tensor(mean, dtype=tf.float32)
+    stdev = tf.convert_to_tensor(stdev, dtype=tf.float32)
+    return _traced_pipeline(_apply_test_transforms, x, mean, stdev)(x, mean, stdev)
 
 
 class PadXYZ:
-    def __init__(self, shape=None):
+    def __init__(self, shape=None, label_value=0):
         self.shape = shape
+        self._label_value = label_value
+        self._paddings = [[0, 0], [0, 0], [0, 5], [0, 0]]
 
     def __call__(self, x, y, mean, stdev):
-        paddings = tf.constant([[0, 0], [0, 0], [0, 5], [0, 0]])
-        x = tf.pad(tensor=x, paddings=paddings, mode="CONSTANT")
+        x = tf.pad(tensor=x, paddings=self._paddings, mode="CONSTANT")
         if y is None:
             return x
-        y = tf.pad(tensor=y, paddings=paddings, mode="CONSTANT")
+        y = tf.pad(tensor=y, paddings=self._paddings[:len(y.shape)], mode="CONSTANT",
+                   constant_values=tf.cast(self._label_value, y.dtype))
         return x, y
 
 
 class CenterCrop:
-    def __init__(self, shape):
+    def __init__(self, shape, input_shape=None):
         self.shape = shape
+        self._slices = self._build_slices(input_shape) if input_shape is not None else None
+
+    def _build_slices(self, input_shape):
+        delta = [(input_shape[i] - self.shape[i]) // 2 for i in range(len(self.shape))]
+        return tuple(slice(delta[i], delta[i] + self.shape[i]) for i in range(len(self.shape)))
 
     def __call__(self, x, y, mean, stdev):
-        shape = x.get_shape()
-        delta = [(shape[i] - self.shape[i]) // 2 for i in range(len(self.shape))]
-        x = x[
-            delta[0]:delta[0] + self.shape[0],
-            delta[1]:delta[1] + self.shape[1],
-            delta[2]:delta[2] + self.shape[2]
-        ]
+        slices = self._slices if self._slices is not None else self._build_slices(x.get_shape())
+        x = x[slices]
         if y is None:
             return x
-        y = y[
-            delta[0]:delta[0] + self.shape[0],
-            delta[1]:delta[1] + self.shape[1],
-            delta[2]:delta[2] + self.shape[2]
-        ]
+        y = y[slices]
         return x, y
 
 
 class RandomCrop3D:
-    def __init__(self, shape, margins=(0, 0, 0)):
+    def __init__(self, shape, margins=(0, 0, 0), input_shape=None):
         self.shape = shape
         self.margins = margins
-
-    def __call__(self, x, y, mean, stdev):
-        shape = x.get_shape()
-        min = tf.constant(self.margins, dtype=tf.float32)
-        max = tf.constant([shape[0] - self.shape[0] - self.margins[0],
-                           shape[1] - self.shape[1] - self.margins[1],
-                           shape[2] - self.shape[2] - self.margins[2]], dtype=tf.float32)
-        center = tf.random.uniform((len(self.shape),), minval=min, maxval=max, seed=params.seed)
-        center = tf.cast(center, dtype=tf.int32)
+        self._min = np.array(margins, dtype=np.float32)
+        self._max = None
+        if input_shape is not None:
+            self.set_input_shape(input_shape)
+
+    def set_input_shape(self, input_shape):
+        self._max = self._build_max(input_shape)
+
+    def _build_max(self, input_shape):
+        return np.array([input_shape[i] - self.shape[i] - self.margins[i] for i in range(len(self.shape))],
+                        dtype=np.float32)
+
+    def num_randoms(self, x):
+        return len(self.shape)
+
+    def __call__(self, x, y, mean, stdev, randoms=None):
+        if randoms is None:
+            randoms = tf.random.uniform([self.num_randoms(x)], seed=params.seed)
+        max = self._max if self._max is not None else self._build_max(x.get_shape())
+        center = tf.cast(_scale(randoms, self._min, max), dtype=tf.int32)
         x = x[center[0]:center[0] + self.shape[0],
               center[1]:center[1] + self.shape[1],
               center[2]:center[2] + self.shape[2]]
@@ -103,8 +167,9 @@ class NormalizeImages:
         pass
 
     def __call__(self, x, y, mean, stdev):
-        mask = tf.math.greater(x, 0)
-        x = tf.compat.v1.where(mask, (x - tf.cast(mean, x.dtype)) / (tf.cast(stdev + 1e-8, x.dtype)), x)
+        # Background voxels are 0, so masking by multiplication keeps them unchanged.
+        mask = tf.cast(tf.math.greater(x, 0), x.dtype)
+        x = mask * ((x - tf.cast(mean, x.dtype)) / (tf.cast(stdev + 1e-8, x.dtype)))
 
         if y is None:
             return x
@@ -121,15 +186,55 @@ class Cast:
         return tf.cast(x, dtype=self._dtype), y
 
 
+class FusedNormalizeCastBrightness:
+    """Cast, NormalizeImages and (optionally) RandomBrightnessCorrection in a single elementwise pass."""
+
+    def __init__(self, dtype=tf.float32, augment=True, alpha=0.1, threshold=0.5, per_channel=True, output_dtype=None):
+        self._dtype = dtype
+        self._output_dtype = output_dtype or dtype
+        self._augment = augment
+        self._alpha_range = [1.0 - alpha, 1.0 + alpha]
+        self._threshold = threshold
+        self._per_channel = per_channel
+
+    def num_randoms(self, x):
+        if not self._augment:
+            return 0
+        return 1 + (x.get_shape()[-1] if self._per_channel else 1)
+
+    def __call__(self, x, y, mean, stdev, randoms=None):
+        x = tf.cast(x, dtype=self._dtype)
+        # Background voxels are 0, so masking by multiplication keeps them unchanged.
+        mask = tf.cast(tf.math.greater(x, 0), x.dtype)
+        x = mask * ((x - tf.cast(mean, x.dtype)) / (tf.cast(stdev + 1e-8, x.dtype)))
+
+        if self._augment:
+            if randoms is None:
+                randoms = tf.random.uniform([self.num_randoms(x)], seed=params.seed)
+            augment = randoms[0] > self._threshold
+            correction = tf.cast(_scale(randoms[1:], self._alpha_range[0], self._alpha_range[1]), x.dtype)
+            x = tf.where(tf.math.logical_and(augment, tf.math.greater(x, 0)), x + correction, x)
+
+        x = tf.cast(x, dtype=self._output_dtype)
+        if y is None:
+            return x
+        return x, y
+
+
 class RandomHorizontalFlip:
     def __init__(self, threshold=0.5):
         self._threshold = threshold
 
-    def __call__(self, x, y, mean, stdev):
-        h_flip = tf.random.uniform([], seed=params.seed) > self._threshold
+    def num_randoms(self, x):
+        return 1
+
+    def __call__(self, x, y, mean, stdev, randoms=None):
+        if randoms is None:
+            randoms = tf.random.uniform([self.num_randoms(x)], seed=params.seed)
+        h_flip = randoms[0] > self._threshold
 
-        x = tf.cond(pred=h_flip, true_fn=lambda: tf.reverse(x, axis=[1]), false_fn=lambda: x)
-        y = tf.cond(pred=h_flip, true_fn=lambda: tf.reverse(y, axis=[1]), false_fn=lambda: y)
+        x = tf.where(h_flip, tf.reverse(x, axis=[1]), x)
+        y = tf.where(h_flip, tf.reverse(y, axis=[1]), y)
 
         return x, y
 
@@ -138,11 +243,16 @@ class RandomVerticalFlip:
     def __init__(self, threshold=0.5):
         self._threshold = threshold
 
-    def __call__(self, x, y, mean, stdev):
-        h_flip = tf.random.uniform([], seed=params.seed) > self._threshold
+    def num_randoms(self, x):
+        return 1
+
+    def __call__(self, x, y, mean, stdev, randoms=None):
+        if randoms is None:
+            randoms = tf.random.uniform([self.num_randoms(x)], seed=params.seed)
+        h_flip = randoms[0] > self._threshold
 
-        x = tf.cond(pred=h_flip, true_fn=lambda: tf.reverse(x, axis=[0]), false_fn=lambda: x)
-        y = tf.cond(pred=h_flip, true_fn=lambda: tf.reverse(y, axis=[0]), false_fn=lambda: y)
+        x = tf.where(h_flip, tf.reverse(x, axis=[0]), x)
+        y = tf.where(h_flip, tf.reverse(y, axis=[0]), y)
 
         return x, y
 
@@ -154,16 +264,21 @@ class RandomGammaCorrection:
         self._eps = epsilon
         self._threshold = threshold
 
-    def __call__(self, x, y, mean, stdev):
-        augment = tf.random.uniform([], seed=params.seed) > self._threshold
-        gamma = tf.random.uniform([], minval=self._gamma_range[0], maxval=self._gamma_range[1], seed=params.seed)
+    def num_randoms(self, x):
+        return 2
 
-        x_min = tf.math.reduce_min(input_tensor=x)
-        x_range = tf.math.reduce_max(input_tensor=x) - x_min
+    def __call__(self, x, y, mean, stdev, randoms=None):
+        if randoms is None:
+            randoms = tf.random.uniform([self.num_randoms(x)], seed=params.seed)
+        augment = randoms[0] > self._threshold
+        gamma = _scale(randoms[1], self._gamma_range[0], self._gamma_range[1])
 
-        x = tf.cond(pred=augment,
-                    true_fn=lambda: tf.math.pow(((x - x_min) / float(x_range + self._eps)), gamma) * x_range + x_min,
-                    false_fn=lambda: x)
+        def _gamma_correction():
+            x_min = tf.math.reduce_min(input_tensor=x)
+            x_range = tf.math.reduce_max(input_tensor=x) - x_min
+            return tf.math.pow(((x - x_min) / (x_range + self._eps)), gamma) * x_range + x_min
+
+        x = tf.cond(pred=augment, true_fn=_gamma_correction, false_fn=lambda: x)
         return x, y
 
 
@@ -173,17 +288,18 @@ class RandomBrightnessCorrection:
         self._threshold = threshold
         self._per_channel = per_channel
 
-    def __call__(self, x, y, mean, stdev):
+    def num_randoms(self, x):
+        return 1 + (x.get_shape()[-1] if self._per_channel else 1)
+
+    def __call__(self, x, y, mean, stdev, randoms=None):
+        if randoms is None:
+            randoms = tf.random.uniform([self.num_randoms(x)], seed=params.seed)
         mask = tf.math.greater(x, 0)
-        size = x.get_shape()[-1] if self._per_channel else 1
-        augment = tf.random.uniform([], seed=params.seed) > self._threshold
-        correction = tf.random.uniform([size],
-                                       minval=self._alpha_range[0],
-                                       maxval=self._alpha_range[1],
-                                       dtype=x.dtype, seed=params.seed)
+        augment = randoms[0] > self._threshold
+        correction = tf.cast(_scale(randoms[1:], self._alpha_range[0], self._alpha_range[1]), x.dtype)
 
         x = tf.cond(pred=augment,
-                    true_fn=lambda: tf.compat.v1.where(mask, x + correction, x),
+                    true_fn=lambda: tf.where(mask, x + correction, x),
                     false_fn=lambda: x)
 
         return x, y
@@ -203,16 +319,20 @@ class PadXY:
             raise ValueError("Invalid padding size: {}".format(dst_size))
 
         self._dst_size = dst_size
+        self._paddings = {}
 
     def __call__(self, x, y, mean, stdev):
         return tf.pad(tensor=x, paddings=self._build_padding(x)), \
             tf.pad(tensor=y, paddings=self._build_padding(y))
 
     def _build_padding(self, _t):
-        padding = []
-        for i in range(len(_t.shape)):
-            if i < len(self._dst_size):
-                padding.append((0, self._dst_size[i] - _t.shape[i]))
-            else:
-                padding.append((0, 0))
-        return padding
+        shape = tuple(_t.shape.as_list())
+        if shape not in self._paddings:
+            padding = []
+            for i in range(len(shape)):
+                if i < len(self._dst_size):
+                    padding.append((0, self._dst_size[i] - shape[i]))
+                else:
+                    padding.append((0, 0))
+            self._paddings[shape] = padding
+        return self._paddings[shape]
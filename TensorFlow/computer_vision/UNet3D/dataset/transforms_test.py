@@ -0,0 +1,81 @@
+# Copyright (C) 2021 Habana Labs, Ltd. an Intel Company
+###############################################################################
+"""Tests for the traced transform pipelines."""
+
+import os
+import sys
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# transforms parses the command line on import, so give it the required flags only.
+_argv = sys.argv
+sys.argv = [_argv[0], '--model_dir', tempfile.gettempdir(), '--data_dir', tempfile.gettempdir()]
+from dataset.transforms import (apply_test_transforms, apply_transforms, CenterCrop,  # noqa: E402
+                                FusedNormalizeCastBrightness, PadXYZ)
+sys.argv = _argv
+
+_XSHAPE = (40, 40, 27, 4)
+_CROP = (32, 32, 27)
+
+
+def _eval_transforms():
+    return [
+        CenterCrop(_CROP, input_shape=_XSHAPE),
+        FusedNormalizeCastBrightness(dtype=tf.float32, augment=False),
+        PadXYZ(label_value=4)
+    ]
+
+
+def _test_transforms():
+    return [
+        CenterCrop(_CROP, input_shape=_XSHAPE),
+        FusedNormalizeCastBrightness(dtype=tf.float32, augment=False),
+        PadXYZ((32, 32, 32))
+    ]
+
+
+class TransformsTest(tf.test.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.RandomState(0)
+        self._x = tf.constant(rng.randint(0, 255, _XSHAPE).astype(np.float32))
+        self._y = tf.constant(rng.randint(0, 4, _XSHAPE[:-1]).astype(np.uint8))
+        self._mean = tf.constant([1.0, 2.0, 3.0, 4.0])
+        self._stdev = tf.constant([2.0, 2.0, 2.0, 2.0])
+
+    def _expected_x(self):
+        x = self._x[4:36, 4:36]
+        x = tf.where(x > 0, (x - self._mean) / (self._stdev + 1e-8), x)
+        return tf.pad(x, [[0, 0], [0, 0], [0, 5], [0, 0]])
+
+    def test_eval_transforms(self):
+        x, y = apply_transforms(self._x, self._y, self._mean, self._stdev, transforms=_eval_transforms())
+        self.assertAllClose(self._expected_x(), x)
+        self.assertAllEqual(tf.pad(self._y[4:36, 4:36], [[0, 0], [0, 0], [0, 5]], constant_values=4), y)
+
+    def test_test_transforms(self):
+        x = apply_test_transforms(self._x, self._mean, self._stdev, transforms=_test_transforms())
+        self.assertAllClose(self._expected_x(), x)
+
+    def test_eval_transforms_in_dataset_map(self):
+        transforms = _eval_transforms()
+        ds = tf.data.Dataset.from_tensors((self._x, self._y, self._mean, self._stdev))
+        ds = ds.map(lambda x, y, mean, stdev: apply_transforms(x, y, mean, stdev, transforms=transforms))
+        x, y = next(iter(ds))
+        self.assertAllClose(self._expected_x(), x)
+        self.assertEqual([32, 32, 32], y.shape.as_list())
+
+    def test_test_transforms_in_dataset_map(self):
+        transforms = _test_transforms()
+        ds = tf.data.Dataset.from_tensors((self._x, self._mean, self._stdev))
+        ds = ds.map(lambda x, mean, stdev: apply_test_transforms(x, mean, stdev, transforms=transforms))
+        self.assertAllClose(self._expected_x(), next(iter(ds)))
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -20,6 +20,7 @@
 # - added tensorboard loss logging
 # - moved horovod import under use_horovod condition so that the user is not required to install this
 #   library when the model is being run on a single card
+# - labels are one-hot encoded here instead of in the input pipeline
 
 import os
 
@@ -32,14 +33,15 @@ from dataset.data_loader import CLASSES
 
 def unet_3d(features, labels, mode, params):
 
-    logits = Builder(n_classes=4, normalization=params.normalization, mode=mode)(features)
+    n_classes = 4
+    logits = Builder(n_classes=n_classes, normalization=params.normalization, mode=mode)(features)
 
     if mode == tf.estimator.ModeKeys.PREDICT:
         prediction = tf.argmax(input=logits, axis=-1, output_type=tf.dtypes.int32)
         return tf.estimator.EstimatorSpec(mode=mode,
                                           predictions={'predictions': tf.cast(prediction, tf.int8)})
 
-    labels = tf.cast(labels, tf.float32)
+    labels = tf.one_hot(tf.cast(labels, tf.int32), depth=n_classes, dtype=tf.float32)
     if not params.include_background:
         labels = labels[..., 1:]
         logits = logits[..., 1:]
@@ -18,7 +18,7 @@
 # - default values for exec_mode, max_steps, log_dir, augment, use_xla, batch_size
 # - added dtype, num_workers_per_hls, kubernetes_run, use_horovod, no-augment, no_xla,
 #   seed, no_hpu, tensorboard_logging, log_all_workers, tf_verbosity, bf16_config_path options,
-#   dump_config, synth_data, disable_ckpt_saving
+#   dump_config, synth_data, disable_ckpt_saving, deterministic_data
 # - included missing help for all available flags
 # - parser has been wraper with Munch dict for more elegant parameter access
 
@@ -104,6 +104,8 @@ def get_parser(description, distributed_launcher):
                         help="""Directory for dumping debug traces""")
     parser.add_argument('--synth_data', dest='synth_data', action='store_true',
                     help="""Use deterministic and synthetic data""")
+    parser.add_argument('--deterministic_data', dest='deterministic_data', action='store_true', default=False,
+                        help="""Preserve element order in parallel input pipeline map stages""")
     parser.add_argument('--disable_ckpt_saving', dest='disable_ckpt_saving', action='store_true',
                         help="""Disables saving checkpoints""")
     parser.add_argument('--no_hpu', dest='no_hpu', action='store_true',
@@ -163,4 +165,5 @@ def parse_args(description="UNet-3D", distributed_launcher=False):
         'dump_config': flags.dump_config,
         'synth_data': flags.synth_data,
         'disable_ckpt_saving': flags.disable_ckpt_saving,
+        'deterministic_data': flags.deterministic_data,
     })
@@ -16,7 +16,8 @@
 # Copyright (C) 2022 Habana Labs, Ltd. an Intel Company
 ###############################################################################
 # Changes:
-# - changed tf.python.ops.alias_inplace_update to tf.add + tf.scatter_nd
+# - changed tf.python.ops.alias_inplace_update to tf.tensor_scatter_nd_add
+# - timing signals of static length are precomputed with NumPy
 
 """Utilities for attention."""
 from __future__ import absolute_import
@@ -40,7 +41,6 @@ from TensorFlow.nlp.transformer.utils import contrib
 from TensorFlow.nlp.transformer.utils import expert_utils
 
 import tensorflow.compat.v1 as tf
-import tensorflow_probability as tfp
 
 # pylint: disable=g-direct-tensorflow-import
 from tensorflow.python.framework import function
@@ -81,7 +81,8 @@ def mixed_precision_is_enabled(
       hasattr(hparams, "weight_dtype")):
     activation_dtype = hparams.activation_dtype
     weight_dtype = hparams.weight_dtype
-  return activation_dtype == tf.float16 and weight_dtype == tf.float32
+  return (activation_dtype in (tf.float16, tf.bfloat16) and
+          weight_dtype == tf.float32)
 
 
 def maybe_upcast(logits,
@@ -91,6 +92,14 @@ def maybe_upcast(logits,
   return logits
 
 
+def compute_dtype_for_attention(hparams):
+  """Dtype for the attention matmuls: the half-precision activation dtype."""
+  activation_dtype = getattr(hparams, "activation_dtype", "float32")
+  if activation_dtype in (tf.float16, tf.bfloat16):
+    return tf.as_dtype(activation_dtype)
+  return tf.float32
+
+
 # Struct containing the sequences ids and order on a batch (are send to the
 # expert to allow them to compute the bias mask)
 BatchInfo = collections.namedtuple("BatchInfo", "coordinates, order")
@@ -119,8 +128,10 @@ def get_standardized_layers(hparams, dp=None):
   """
 
   def partial(fct, *args, **kwargs):
-    """Same as functools.partial but with functools.wraps."""
-    return functools.wraps(fct)(functools.partial(fct, *args, **kwargs))
+    """Same as functools.partial but keeps the __name__ of fct."""
+    p = functools.partial(fct, *args, **kwargs)
+    p.__name__ = getattr(fct, "__name__", "partial")
+    return p
 
   def register_layer(
       fct_in,
@@ -188,11 +199,18 @@ def get_standardized_layers(hparams, dp=None):
           output_depth=hparams.hidden_size,
           num_heads=hparams.num_heads,
           dropout_rate=hparams.attention_dropout,
+          qkv_compute_dtype=compute_dtype_for_attention(hparams),
+          softmax_dtype=tf.float32,
+          kv_block_size=getattr(hparams, "attention_kv_block_size", 0),
       ))
 
   # === Memory efficient full-attention layer ===
   # Save memory by not storing the activations and
-  # recomputing them during the backward pass
+  # recomputing them during the backward pass. By default only the
+  # softmax(QK^T)V block is recomputed, not the input/output projections.
+  memeff_recompute_grad = getattr(hparams, "memeff_recompute_grad", True)
+  memeff_recompute_attention_only = getattr(
+      hparams, "memeff_recompute_attention_only", True)
   memeff_attention_base_fn = register_layer(
       multihead_attention,
       default_kwargs=dict(
@@ -201,8 +219,11 @@ def get_standardized_layers(hparams, dp=None):
           output_depth=hparams.hidden_size,
           num_heads=hparams.num_heads,
           dropout_rate=hparams.attention_dropout,
+          recompute_attention=(memeff_recompute_grad and
+                               memeff_recompute_attention_only),
       ),
-      recompute_grad=True,
+      recompute_grad=(memeff_recompute_grad and
+                      not memeff_recompute_attention_only),
   )
 
   def memeff_attention_fn(*args, **kwargs):
@@ -219,6 +240,10 @@ def get_standardized_layers(hparams, dp=None):
       args = (x, memory_antecedent)
     return memeff_attention_base_fn(*args, **kwargs)
 
+  # With use_block_sparse, the local attention layers only compute the
+  # (query block, key/value block) pairs inside the band.
+  use_block_sparse = getattr(hparams, "use_block_sparse", False)
+
   # === Local attention (unmasked) layer ===
   # Reuse same parameters as multihead_attention
   # Don't mask the future
@@ -226,7 +251,8 @@ def get_standardized_layers(hparams, dp=None):
       multihead_attention_fn,
       block_length=hparams.attention_loc_block_length,
       block_width=hparams.attention_loc_block_width,
-      attention_type="local_unmasked",
+      attention_type=("local_block_sparse" if use_block_sparse
+                      else "local_unmasked"),
   )
 
   # === Local attention (masked) layer ===
@@ -235,7 +261,8 @@ def get_standardized_layers(hparams, dp=None):
   local_attention_masked_fn = partial(
       multihead_attention_fn,
       block_length=hparams.attention_loc_block_length,
-      attention_type="local_mask_right",
+      attention_type=("local_block_sparse_mask_right" if use_block_sparse
+                      else "local_mask_right"),
   )
 
   # === Masked memory-compressed multihead self attention layer ===
@@ -336,14 +363,23 @@ def add_standard_attention_hparams(hparams):
   hparams.add_hparam("attention_key_channels", 0)
   hparams.add_hparam("attention_value_channels", 0)
   hparams.add_hparam("attention_dropout", 0.0)
+  # If > 0, full attention processes the memory in blocks of this many
+  # positions with an online softmax instead of materializing all logits.
+  hparams.add_hparam("attention_kv_block_size", 0)
   # Attention: Local
   hparams.add_hparam("attention_loc_block_length", 256)
   # Attention: Local (unmasked only): How much to look left.
   hparams.add_hparam("attention_loc_block_width", 128)
+  hparams.add_hparam("use_block_sparse", False)
   # Attention: Memory-compressed
   hparams.add_hparam("attention_red_factor", 3)
   hparams.add_hparam("attention_red_type", "conv")
   hparams.add_hparam("attention_red_nonlinearity", "none")
+  # Attention: Memory efficient
+  # Whether to recompute the attention activations in the backward pass, and
+  # if so, whether to recompute only softmax(QK^T)V or the whole layer.
+  hparams.add_hparam("memeff_recompute_grad", True)
+  hparams.add_hparam("memeff_recompute_attention_only", True)
 
   # Fully connected layers flags
   # To be more consistent, should use filter_size to also control the MOE
@@ -374,17 +410,17 @@ def encoder_decoder_attention_loss(expected_attention_logits,
 
   def combine_attentions(attention_list):
     """Combine different layer attentions and then average over layers/heads."""
-    # Stack all hidden layer attention tensors to get a tensor with shape
-    # [num_hidden_layers, batch_size, num_heads, target_length, input_length].
-    attentions = tf.stack(attention_list)
-    # Reduce mean across all layers (axis=0) and all heads (axis=2) to get a
-    # tensor with shape [batch_size, target_length, input_length].
-    return tf.reduce_mean(attentions, [0, 2])
+    # Average all hidden layer attention tensors with an accumulating sum
+    # rather than stacking them into a [num_hidden_layers, ...] tensor.
+    attentions = tf.add_n(attention_list) * (1.0 / len(attention_list))
+    # Reduce mean across all heads (axis=1) to get a tensor with shape
+    # [batch_size, target_length, input_length].
+    return tf.reduce_mean(attentions, 1)
 
   def kl_divergence_loss(expected_logits, actual_logits):
-    p = tfp.distributions.Categorical(logits=expected_logits)
-    q = tfp.distributions.Categorical(logits=actual_logits)
-    return tfp.distributions.kl_divergence(p, q)
+    log_p = tf.nn.log_softmax(expected_logits, axis=-1)
+    log_q = tf.nn.log_softmax(actual_logits, axis=-1)
+    return tf.reduce_sum(tf.exp(log_p) * (log_p - log_q), axis=-1)
 
   def mse_loss(expected_logits, actual_weights):
     expected_weights = tf.nn.softmax(expected_logits)
@@ -412,12 +448,53 @@ def encoder_decoder_attention_loss(expected_attention_logits,
   return loss * loss_multiplier
 
 
+@functools.lru_cache(maxsize=32)
+def _inv_timescales_np(num_timescales, min_timescale, max_timescale):
+  """Geometric sequence of inverse timescales shared by the timing signals."""
+  log_timescale_increment = (
+      math.log(float(max_timescale) / float(min_timescale)) /
+      max(num_timescales - 1, 1))
+  return np.float32(min_timescale) * np.exp(
+      np.arange(num_timescales, dtype=np.float32) *
+      np.float32(-log_timescale_increment))
+
+
+def _get_inv_timescales(num_timescales, min_timescale, max_timescale):
+  """Returns the [num_timescales] inverse timescales as a float32 Tensor."""
+  if isinstance(num_timescales, int):
+    return tf.constant(_inv_timescales_np(num_timescales, float(min_timescale),
+                                          float(max_timescale)))
+  log_timescale_increment = (
+      math.log(float(max_timescale) / float(min_timescale)) /
+      tf.maximum(to_float(num_timescales) - 1, 1))
+  return min_timescale * tf.exp(
+      to_float(tf.range(num_timescales)) * -log_timescale_increment)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_timing_signal_1d_np(length, channels, min_timescale, max_timescale,
+                             start_index):
+  """NumPy version of get_timing_signal_1d for static arguments."""
+  position = (np.arange(length) + start_index).astype(np.float32)
+  num_timescales = channels // 2
+  inv_timescales = _inv_timescales_np(num_timescales, min_timescale,
+                                      max_timescale)
+  scaled_time = np.expand_dims(position, 1) * np.expand_dims(inv_timescales, 0)
+  # Write sin/cos straight into the two halves of the output; an odd channel
+  # count leaves the last column as zero padding.
+  signal = np.zeros([1, length, channels], dtype=np.float32)
+  np.sin(scaled_time, out=signal[0, :, :num_timescales])
+  np.cos(scaled_time, out=signal[0, :, num_timescales:2 * num_timescales])
+  return signal
+
+
 @expert_utils.add_name_scope()
 def get_timing_signal_1d(length,
                          channels,
                          min_timescale=1.0,
                          max_timescale=1.0e4,
-                         start_index=0):
+                         start_index=0,
+                         dtype=tf.float32):
   """Gets a bunch of sinusoids of different frequencies.
 
   Each channel of the input Tensor is incremented by a sinusoid of a different
@@ -444,22 +521,31 @@ def get_timing_signal_1d(length,
     min_timescale: a float
     max_timescale: a float
     start_index: index of first position
+    dtype: dtype of the returned signal. The sinusoids are always computed in
+        float32.
 
   Returns:
     a Tensor of timing signals [1, length, channels]
   """
+  if all(isinstance(a, int) for a in (length, channels, start_index)):
+    return tf.constant(
+        _get_timing_signal_1d_np(length, channels, float(min_timescale),
+                                 float(max_timescale), start_index),
+        dtype=dtype)
   position = tf.cast(tf.range(length) + start_index, tf.float32)
   num_timescales = channels // 2
-  log_timescale_increment = (
-      math.log(float(max_timescale) / float(min_timescale)) /
-      tf.maximum(to_float(num_timescales) - 1, 1))
-  inv_timescales = min_timescale * tf.exp(
-      to_float(tf.range(num_timescales)) * -log_timescale_increment)
+  inv_timescales = _get_inv_timescales(num_timescales, min_timescale,
+                                       max_timescale)
   scaled_time = tf.expand_dims(position, 1) * tf.expand_dims(inv_timescales, 0)
   # Please note that this slightly differs from the published paper.
   # See a discussion here: https://github.com/tensorflow/tensor2tensor/pull/177
   signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=1)
-  signal = tf.pad(signal, [[0, 0], [0, tf.mod(channels, 2)]])
+  signal = tf.cast(signal, dtype)
+  # channels is almost always even, in which case no padding is needed.
+  if not isinstance(channels, int):
+    signal = tf.pad(signal, [[0, 0], [0, tf.mod(channels, 2)]])
+  elif channels % 2:
+    signal = tf.pad(signal, [[0, 0], [0, 1]])
   signal = tf.reshape(signal, [1, length, channels])
   return signal
 
@@ -500,8 +586,8 @@ def add_timing_signal_1d(x,
   length = common_layers.shape_list(x)[1]
   channels = common_layers.shape_list(x)[2]
   signal = get_timing_signal_1d(length, channels, min_timescale, max_timescale,
-                                start_index)
-  return x + common_layers.cast_like(signal, x)
+                                start_index, dtype=x.dtype)
+  return x + signal
 
 
 @expert_utils.add_name_scope()
@@ -549,19 +635,21 @@ def add_layer_timing_signal_learned_1d(x, layer, num_layers):
 
 
 @expert_utils.add_name_scope()
-def get_layer_timing_signal_sinusoid_1d(channels, layer, num_layers):
+def get_layer_timing_signal_sinusoid_1d(channels, layer, num_layers,
+                                        dtype=tf.float32):
   """Add sinusoids of different frequencies as layer (vertical) timing signal.
 
   Args:
     channels: dimension of the timing signal
     layer: layer num
     num_layers: total number of layers
+    dtype: dtype of the returned signal
 
   Returns:
     a Tensor of timing signals [1, 1, channels].
   """
 
-  signal = get_timing_signal_1d(num_layers, channels)
+  signal = get_timing_signal_1d(num_layers, channels, dtype=dtype)
   layer_signal = tf.expand_dims(signal[:, layer, :], axis=1)
 
   return layer_signal
@@ -581,7 +669,8 @@ def add_layer_timing_signal_sinusoid_1d(x, layer, num_layers):
   """
 
   channels = common_layers.shape_list(x)[-1]
-  signal = get_layer_timing_signal_sinusoid_1d(channels, layer, num_layers)
+  signal = get_layer_timing_signal_sinusoid_1d(channels, layer, num_layers,
+                                               dtype=x.dtype)
 
   return x + signal
 
@@ -609,26 +698,32 @@ def add_timing_signals_given_positions(x,
   channels = shape[2]
   num_dims = len(positions)
   num_timescales = channels // (num_dims * 2)
-  log_timescale_increment = (
-      math.log(float(max_timescale) / float(min_timescale)) /
-      (to_float(num_timescales) - 1))
-  inv_timescales = min_timescale * tf.exp(
-      to_float(tf.range(num_timescales)) * -log_timescale_increment)
-  for dim, position in enumerate(positions):
+  # [1, 1, num_timescales]
+  inv_timescales = tf.reshape(
+      _get_inv_timescales(num_timescales, min_timescale, max_timescale),
+      [1, 1, num_timescales])
+  # The signals of all dims partition the channels, so they are concatenated
+  # and added to x in a single pass.
+  # Default positions 0..length-1 are computed once for [1, length] and only
+  # broadcast over batch if they are concatenated with given positions.
+  mixed = any(position is not None for position in positions)
+  signals = []
+  for position in positions:
     if position is None:
-      # Create a [batch, length] Tensor of incrementing positions 0..length-1.
-      position = tf.tile(
-          tf.transpose(tf.expand_dims(tf.range(0, length), axis=1)), [batch, 1])
-    scaled_time = (
-        tf.expand_dims(to_float(position), 2) *
-        tf.expand_dims(tf.expand_dims(inv_timescales, 0), 0))
-    signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=2)
-    prepad = dim * 2 * num_timescales
-    postpad = channels - (dim + 1) * 2 * num_timescales
-    signal = tf.pad(signal, [[0, 0], [0, 0], [prepad, postpad]])
-    signal = common_layers.cast_like(signal, x)
-    x += signal
-  return x
+      scaled_time = (
+          tf.reshape(to_float(tf.range(0, length)), [1, length, 1]) *
+          inv_timescales)
+      if mixed:
+        scaled_time = tf.broadcast_to(scaled_time,
+                                      [batch, length, num_timescales])
+    else:
+      scaled_time = tf.expand_dims(to_float(position), 2) * inv_timescales
+    signals.extend([tf.sin(scaled_time), tf.cos(scaled_time)])
+  signal = tf.concat(signals, axis=2)
+  signal = common_layers.cast_like(signal, x)
+  postpad = channels - num_dims * 2 * num_timescales
+  signal = tf.pad(signal, [[0, 0], [0, 0], [0, postpad]])
+  return x + signal
 
 
 @expert_utils.add_name_scope()
@@ -661,7 +756,8 @@ def add_timing_signals_from_features(x,
 def add_timing_signal_1d_given_position(x,
                                         position,
                                         min_timescale=1.0,
-                                        max_timescale=1.0e4):
+                                        max_timescale=1.0e4,
+                                        max_position=None):
   """Adds sinusoids of diff frequencies to a Tensor, with timing position given.
 
   Args:
@@ -669,26 +765,58 @@ def add_timing_signal_1d_given_position(x,
     position: a Tensor with shape [batch, length]
     min_timescale: a float
     max_timescale: a float
+    max_position: an optional integer. If given and position is an integer
+      Tensor with values in [0, max_position), the signal is gathered from a
+      precomputed [max_position, channels] table instead of being computed.
 
   Returns:
     a Tensor the same shape as x.
   """
   channels = common_layers.shape_list(x)[2]
+  if (max_position is not None and isinstance(channels, int) and
+      position.dtype.is_integer):
+    table = _get_timing_signal_1d_np(max_position, channels,
+                                     float(min_timescale),
+                                     float(max_timescale), 0)[0]
+    return x + tf.gather(tf.constant(table, dtype=x.dtype), position)
   num_timescales = channels // 2
-  log_timescale_increment = (
-      math.log(float(max_timescale) / float(min_timescale)) /
-      (tf.cast(num_timescales, tf.float32) - 1))
-  inv_timescales = min_timescale * tf.exp(
-      tf.cast(tf.range(num_timescales), tf.float32) * -log_timescale_increment)
+  inv_timescales = _get_inv_timescales(num_timescales, min_timescale,
+                                       max_timescale)
   scaled_time = (
       tf.expand_dims(to_float(position), 2) * tf.expand_dims(
           tf.expand_dims(inv_timescales, 0), 0))
   signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=2)
-  signal = tf.pad(signal, [[0, 0], [0, 0], [0, tf.mod(channels, 2)]])
   signal = common_layers.cast_like(signal, x)
+  if not isinstance(channels, int):
+    signal = tf.pad(signal, [[0, 0], [0, 0], [0, tf.mod(channels, 2)]])
+  elif channels % 2:
+    signal = tf.pad(signal, [[0, 0], [0, 0], [0, 1]])
   return x + signal
 
 
+@functools.lru_cache(maxsize=32)
+def _get_timing_signal_nd_np(positional_shape, channels, min_timescale,
+                             max_timescale):
+  """NumPy version of the add_timing_signal_nd signal for static shapes."""
+  num_dims = len(positional_shape)
+  num_timescales = channels // (num_dims * 2)
+  inv_timescales = _inv_timescales_np(num_timescales, min_timescale,
+                                      max_timescale)
+  signals = []
+  for dim, length in enumerate(positional_shape):
+    position = np.arange(length, dtype=np.float32)
+    scaled_time = np.expand_dims(position, 1) * np.expand_dims(
+        inv_timescales, 0)
+    signal = np.concatenate([np.sin(scaled_time), np.cos(scaled_time)], axis=1)
+    signal = np.reshape(signal, [1] * (1 + dim) + [length] +
+                        [1] * (num_dims - 1 - dim) + [2 * num_timescales])
+    signals.append(np.broadcast_to(
+        signal, [1] + list(positional_shape) + [2 * num_timescales]))
+  signal = np.concatenate(signals, axis=-1)
+  postpad = channels - num_dims * 2 * num_timescales
+  return np.pad(signal, [[0, 0]] * (num_dims + 1) + [[0, postpad]])
+
+
 @expert_utils.add_name_scope()
 def add_timing_signal_nd(x, min_timescale=1.0, max_timescale=1.0e4):
   """Adds a bunch of sinusoids of different frequencies to a Tensor.
@@ -724,26 +852,35 @@ def add_timing_signal_nd(x, min_timescale=1.0, max_timescale=1.0e4):
   num_dims = len(x.get_shape().as_list()) - 2
   channels = common_layers.shape_list(x)[-1]
   num_timescales = channels // (num_dims * 2)
-  log_timescale_increment = (
-      math.log(float(max_timescale) / float(min_timescale)) /
-      (to_float(num_timescales) - 1))
-  inv_timescales = min_timescale * tf.exp(
-      to_float(tf.range(num_timescales)) * -log_timescale_increment)
+  static_shape = x.get_shape().as_list()[1:]
+  if all(isinstance(d, int) for d in static_shape):
+    signal = _get_timing_signal_nd_np(tuple(static_shape[:-1]), channels,
+                                      float(min_timescale),
+                                      float(max_timescale))
+    return x + tf.constant(signal, dtype=x.dtype)
+  # [1, num_timescales]
+  inv_timescales = tf.reshape(
+      _get_inv_timescales(num_timescales, min_timescale, max_timescale),
+      [1, num_timescales])
+  # The signals of all dims partition the channels, so they are broadcast to
+  # the positional shape, concatenated and added to x in a single pass.
+  positional_shape = common_layers.shape_list(x)[1:-1]
+  signals = []
   for dim in range(num_dims):
-    length = common_layers.shape_list(x)[dim + 1]
+    length = positional_shape[dim]
     position = to_float(tf.range(length))
-    scaled_time = tf.expand_dims(position, 1) * tf.expand_dims(
-        inv_timescales, 0)
+    scaled_time = tf.expand_dims(position, 1) * inv_timescales
     signal = tf.concat([tf.sin(scaled_time), tf.cos(scaled_time)], axis=1)
-    prepad = dim * 2 * num_timescales
-    postpad = channels - (dim + 1) * 2 * num_timescales
-    signal = tf.pad(signal, [[0, 0], [prepad, postpad]])
     for _ in range(1 + dim):
       signal = tf.expand_dims(signal, 0)
     for _ in range(num_dims - 1 - dim):
       signal = tf.expand_dims(signal, -2)
-    x += signal
-  return x
+    signals.append(tf.broadcast_to(
+        signal, [1] + positional_shape + [2 * num_timescales]))
+  signal = tf.concat(signals, axis=-1)
+  postpad = channels - num_dims * 2 * num_timescales
+  signal = tf.pad(signal, [[0, 0]] * (num_dims + 1) + [[0, postpad]])
+  return x + common_layers.cast_like(signal, x)
 
 
 def add_positional_embedding(x, max_length, name=None, positions=None):
@@ -762,14 +899,21 @@ def add_positional_embedding(x, max_length, name=None, positions=None):
     _, length, depth = common_layers.shape_list(x)
     var = tf.cast(tf.get_variable(name, [max_length, depth]), x.dtype)
     if positions is None:
-      pad_length = tf.maximum(0, length - max_length)
-      sliced = tf.cond(
-          tf.less(length, max_length),
-          lambda: tf.slice(var, [0, 0], [length, -1]),
-          lambda: tf.pad(var, [[0, pad_length], [0, 0]]))
+      if isinstance(length, int):
+        if length <= max_length:
+          sliced = var[:length]
+        else:
+          sliced = tf.pad(var, [[0, length - max_length], [0, 0]])
+      else:
+        pad_length = tf.maximum(0, length - max_length)
+        sliced = tf.pad(var[:tf.minimum(length, max_length)],
+                        [[0, pad_length], [0, 0]])
       return x + tf.expand_dims(sliced, 0)
     else:
-      return x + tf.gather(var, tf.to_int32(positions))
+      # tf.gather takes int32 and int64 indices as they are.
+      if positions.dtype not in (tf.int32, tf.int64):
+        positions = tf.cast(positions, tf.int32)
+      return x + tf.gather(var, positions)
 
 
 def add_positional_embedding_nd(x, max_length, name=None):
@@ -808,7 +952,8 @@ def add_positional_embedding_nd(x, max_length, name=None):
     return x
 
 
-def make_edge_vectors(adjacency_matrix, num_edge_types, depth, name=None):
+def make_edge_vectors(adjacency_matrix, num_edge_types, depth, name=None,
+                      use_gather=True):
   """Gets edge vectors for the edge types in the adjacency matrix.
 
   Args:
@@ -816,6 +961,9 @@ def make_edge_vectors(adjacency_matrix, num_edge_types, depth, name=None):
     num_edge_types: Number of different edge types
     depth: Number of channels
     name: a string
+    use_gather: if True, look the edge vectors up with tf.gather. Otherwise
+      contract a one-hot of the adjacency matrix with them, which avoids
+      gathers (e.g. on TPU).
   Returns:
     A [batch, num_nodes, num_nodes, depth] vector of tensors
   """
@@ -828,6 +976,8 @@ def make_edge_vectors(adjacency_matrix, num_edge_types, depth, name=None):
             att_adj_vectors_shape,
             initializer=tf.random_normal_initializer(0, depth**-0.5)) *
         (depth**0.5))
+    if use_gather:
+      return tf.gather(adj_vectors, adjacency_matrix)
     # Avoiding gathers so that it works on TPUs
     # adjacency_matrix_one_hot has shape
     # [batch, num_nodes, num_nodes, num_edge_types]
@@ -879,25 +1029,24 @@ class LshGating(object):
       )
       # Projection vector from the bit space to similarity score space
       self.t_group = tf.constant(
-          [self._idx_to_bits(i) for i in range(self.nb_buckets)],
-          dtype=tf.float32,
-          name="group")
+          self._bits_table(), dtype=tf.float32, name="group")
 
-  def _idx_to_bits(self, i):
-    """Convert an group index to its bit representation."""
-    bits = bin(i)[2:].zfill(self.nb_hyperplanes)  # Pad the bits str with 0
-    return [-1.0 if b == "0" else 1.0 for b in bits]
+  def _bits_table(self):
+    """Bit representation (-1.0/1.0, MSB first) of every group index."""
+    idx = np.arange(self.nb_buckets, dtype=np.int64)
+    shifts = np.arange(self.nb_hyperplanes - 1, -1, -1, dtype=np.int64)
+    bits = (idx[:, None] >> shifts) & 1
+    return bits.astype(np.float32) * 2.0 - 1.0
 
   @expert_utils.add_name_scope("lsh_gating")
-  def get_gates(self, x):
-    """Return the bucket id of the given tensor.
+  def get_gate_indices(self, x):
+    """Return the bucket id of the given tensor, without the one-hot.
 
     Args:
       x (tf.Tensor): float32 of shape [length, depth]
 
     Returns:
-      tf.Tensor: One-hot vector int64 of shape [heads, length, nb_buckets]
-        containing the id of the bucket
+      tf.Tensor: int32 of shape [length] containing the id of the bucket
     """
 
     # The balance loss don't propagate to the rest of the network
@@ -907,20 +1056,31 @@ class LshGating(object):
     # [length, nb_vector * replicat]
     x = tf.sign(x)  # Get on which side of the hyperplane the keys are.
 
-    # x = tf.reshape(x, [-1, nb_replicat, nb_vector])
-    # [length, replicat, nb_vector] * [nb_vector, 2^nb_vector - 1]
-
-    x = tf.matmul(x, self.t_group, transpose_b=True) / self.nb_hyperplanes
-    # We get a similarity score for each of the group between [-1, 1]
-    # [length, (replicat,) 2^nb_vector - 1]
-    # Do an argmax to get the most likely group for each replicat
-    x = tf.argmax(x, axis=-1)
+    # The most similar row of t_group is the one whose bits match the signs,
+    # so the argmax over the groups is the sign bits packed into an integer
+    # (ties at 0 go to the lower index, i.e. bit 0).
+    bits = tf.cast(tf.greater(x, 0.0), tf.int32)
+    place_values = tf.constant(
+        np.left_shift(1, np.arange(self.nb_hyperplanes - 1, -1, -1)),
+        dtype=tf.int32)
+    x = tf.reduce_sum(bits * place_values, axis=-1)
     # [length(, replicat)]
-    # One-hot for compatibility with the sparse dispatcher
-    x = tf.one_hot(x, self.nb_buckets)
     # TODO(epot): Use a loss to force an even distribution
     return x
 
+  def get_gates(self, x):
+    """Return the bucket id of the given tensor.
+
+    Args:
+      x (tf.Tensor): float32 of shape [length, depth]
+
+    Returns:
+      tf.Tensor: One-hot vector int64 of shape [heads, length, nb_buckets]
+        containing the id of the bucket
+    """
+    # One-hot for compatibility with the sparse dispatcher
+    return tf.one_hot(self.get_gate_indices(x), self.nb_buckets)
+
 
 @expert_utils.add_name_scope()
 def embedding_to_padding(emb):
@@ -935,8 +1095,8 @@ def embedding_to_padding(emb):
     a float Tensor with shape [...]. Each element is 1 if its corresponding
     embedding vector is all zero, and is 0 otherwise.
   """
-  emb_sum = tf.reduce_sum(tf.abs(emb), axis=-1)
-  return to_float(tf.equal(emb_sum, 0.0))
+  return to_float(
+      tf.logical_not(tf.reduce_any(tf.not_equal(emb, 0.0), axis=-1)))
 
 
 @expert_utils.add_name_scope()
@@ -948,8 +1108,9 @@ def padding_to_length(padding):
   Returns:
     a Tensor with shape [...].
   """
-  non_padding = 1.0 - padding
-  return tf.to_int32(tf.reduce_sum(non_padding, axis=-1))
+  # padding is 0/1, so count it directly instead of materializing 1 - padding
+  length = common_layers.shape_list(padding)[-1]
+  return length - tf.to_int32(tf.reduce_sum(padding, axis=-1))
 
 
 @expert_utils.add_name_scope()
@@ -980,6 +1141,46 @@ def attention_bias_local(length, max_backward, max_forward):
   return -1e9 * (1.0 - band)
 
 
+@functools.lru_cache(maxsize=32)
+def _attention_bias_band_np(rows, cols, num_lower, num_upper, ndims):
+  """NumPy -1e9 bias outside a band, shaped [1, ..., 1, rows, cols]."""
+  if num_lower < 0:
+    num_lower = rows - 1
+  if num_upper < 0:
+    num_upper = cols - 1
+  band = np.tril(np.triu(np.ones((rows, cols), np.float32), -num_lower),
+                 num_upper)
+  bias = np.float32(-1e9) * (1.0 - band)
+  return bias.reshape([1] * (ndims - 2) + [rows, cols])
+
+
+def _attention_bias_band(rows, cols, num_lower, num_upper, ndims):
+  """Bias masking positions outside a band, as a [1, ..., rows, cols] Tensor.
+
+  Static sizes are served from a cached NumPy array so the bias is a single
+  broadcastable constant; dynamic sizes fall back to ones_matrix_band_part.
+
+  Args:
+    rows: int or scalar Tensor, number of query positions.
+    cols: int or scalar Tensor, number of memory positions.
+    num_lower: int, maximum distance backward. Negative values indicate
+      unlimited.
+    num_upper: int, maximum distance forward. Negative values indicate
+      unlimited.
+    ndims: int, rank of the returned bias.
+
+  Returns:
+    a float32 `Tensor` with shape [1, ..., 1, rows, cols].
+  """
+  if all(isinstance(el, int) for el in [rows, cols, num_lower, num_upper]):
+    return tf.constant(
+        _attention_bias_band_np(rows, cols, num_lower, num_upper, ndims))
+  band = common_layers.ones_matrix_band_part(
+      rows, cols, num_lower, num_upper,
+      out_shape=[1] * (ndims - 2) + [rows, cols])
+  return (1.0 - band) * -1e9
+
+
 @expert_utils.add_name_scope()
 def attention_bias_lower_triangle(length):
   """Create an bias tensor to be added to attention logits.
@@ -1073,12 +1274,20 @@ def attention_bias_prepend_inputs_full_attention(padding):
   # The position within the target, or 0 if part of the source.
   target_pos = tf.cumsum(in_target, axis=1)
   # A position with a lesser target_pos cannot see a position with greater
-  # target_pos.
+  # target_pos. Only the [batch, length] target_pos is expanded, so the
+  # comparison directly produces the [batch, 1, length, length] mask.
+  target_pos = tf.expand_dims(target_pos, 1)
   illegal_connections = tf.greater(
-      tf.expand_dims(target_pos, 1), tf.expand_dims(target_pos, 2))
-  bias = to_float(illegal_connections) * -1e9
-  bias = tf.expand_dims(bias, 1)
-  return bias
+      tf.expand_dims(target_pos, 2), tf.expand_dims(target_pos, 3))
+  return to_float(illegal_connections) * -1e9
+
+
+@functools.lru_cache(maxsize=32)
+def _attention_bias_proximal_np(length):
+  """NumPy version of attention_bias_proximal for a static length."""
+  r = np.arange(length, dtype=np.float32)
+  diff = np.expand_dims(r, 0) - np.expand_dims(r, 1)
+  return np.reshape(-np.log1p(np.abs(diff)), [1, 1, length, length])
 
 
 @expert_utils.add_name_scope()
@@ -1091,6 +1300,8 @@ def attention_bias_proximal(length):
   Returns:
     a Tensor with shape [1, 1, length, length]
   """
+  if isinstance(length, int):
+    return tf.constant(_attention_bias_proximal_np(length))
   r = to_float(tf.range(length))
   diff = tf.expand_dims(r, 0) - tf.expand_dims(r, 1)
   return tf.expand_dims(tf.expand_dims(-tf.log1p(tf.abs(diff)), 0), 0)
@@ -1099,7 +1310,8 @@ def attention_bias_proximal(length):
 @expert_utils.add_name_scope()
 def attention_bias_batch(batch_coordinates_q,
                          batch_coordinates_k=None,
-                         condition_fn=None):
+                         condition_fn=None,
+                         mask_fn=None):
   """Generate a mask to prevent the batch to attend to each others.
 
   Args:
@@ -1108,6 +1320,10 @@ def attention_bias_batch(batch_coordinates_q,
     batch_coordinates_k: Int-like Tensor of shape [length_k, 1] containing the
       coordinates of the batches. If None, do self-attention.
     condition_fn: Callable defining the attention mask.
+    mask_fn: Optional callable taking the query coordinates [length_q, 1] and
+      the key coordinates [1, length_k] and returning a boolean Tensor which is
+      True for illegal connections. When given, the coordinates are compared
+      directly and condition_fn is ignored.
 
   Returns:
     Float-like Tensor of shape [length_q, length_k] containing either 0 or
@@ -1116,15 +1332,22 @@ def attention_bias_batch(batch_coordinates_q,
   if batch_coordinates_k is None:
     batch_coordinates_k = batch_coordinates_q
 
+  if mask_fn is not None:
+    # Compare the coordinates in their own dtype: no float round trip and no
+    # intermediate [length_q, length_k] arithmetic before the mask.
+    bc_v = batch_coordinates_q
+    bc_h = tf.transpose(batch_coordinates_k)
+    return to_float(mask_fn(bc_v, bc_h)) * -1e9
+
   # Convert to float first because of b/25387198.
-  def to_float(bc):
+  def squeeze_to_float(bc):
     bc = tf.squeeze(bc, 1)
     bc = to_float(bc)
     return bc
 
   # Broadcast to create [length_q, length_k] mask.
-  bc_v = tf.expand_dims(to_float(batch_coordinates_q), 1)
-  bc_h = tf.expand_dims(to_float(batch_coordinates_k), 0)
+  bc_v = tf.expand_dims(squeeze_to_float(batch_coordinates_q), 1)
+  bc_h = tf.expand_dims(squeeze_to_float(batch_coordinates_k), 0)
   bias_batch = bc_h - bc_v
   bias_batch = condition_fn(bias_batch)
   bias_batch *= -1e9
@@ -1134,19 +1357,40 @@ def attention_bias_batch(batch_coordinates_q,
 # Mask to prevent individual sequences of the same batch to attend to each other
 attention_bias_coordinates = functools.partial(
     attention_bias_batch,
-    condition_fn=lambda bias: tf.minimum(1.0, tf.abs(bias)),
+    mask_fn=tf.not_equal,
 )
 
 # Mask similar to upper triangular mask, but allow dispatching
 attention_bias_future = functools.partial(
     attention_bias_batch,
-    # Elems can attend to themselves (otherwise would use bias_batch + 1.0).
-    # No tf.abs to consider the order,
-    # tf.maximum and tf.minimum to threshold the values.
-    condition_fn=lambda bias: tf.maximum(0.0, tf.minimum(1.0, bias)),
+    # Elems can attend to themselves (otherwise would use tf.less_equal).
+    # Only the keys placed after the query are masked.
+    mask_fn=lambda q, k: tf.greater(k, q),
 )
 
 
+def _static_reshape_prefix(x, num_trailing):
+  """Static reshape target for all but the last num_trailing dims of x.
+
+  Args:
+    x: a Tensor.
+    num_trailing: an integer, number of trailing dimensions which must be
+      static.
+
+  Returns:
+    a tuple (prefix, trailing) of Python int lists, with the only unknown
+    prefix dimension (if any) replaced by -1, or None if the rank is unknown,
+    a trailing dimension is unknown or more than one prefix dimension is.
+  """
+  static = x.get_shape().as_list() if x.get_shape().dims is not None else None
+  if static is None or None in static[len(static) - num_trailing:]:
+    return None
+  prefix = static[:len(static) - num_trailing]
+  if prefix.count(None) > 1:
+    return None
+  return [-1 if d is None else d for d in prefix], static[len(prefix):]
+
+
 @expert_utils.add_name_scope()
 def split_last_dimension(x, n):
   """Reshape x so that the last dimension becomes two dimensions.
@@ -1160,6 +1404,12 @@ def split_last_dimension(x, n):
   Returns:
     a Tensor with shape [..., n, m/n]
   """
+  static_shape = _static_reshape_prefix(x, 1)
+  if static_shape is not None and isinstance(n, int):
+    # Pure Python-int target shape: no Shape/Pack ops in the graph.
+    prefix, (m,) = static_shape
+    assert m % n == 0
+    return tf.reshape(x, prefix + [n, m // n])
   x_shape = common_layers.shape_list(x)
   m = x_shape[-1]
   if isinstance(m, int) and isinstance(n, int):
@@ -1177,6 +1427,10 @@ def combine_last_two_dimensions(x):
   Returns:
     a Tensor with shape [..., ab]
   """
+  static_shape = _static_reshape_prefix(x, 2)
+  if static_shape is not None:
+    prefix, (a, b) = static_shape
+    return tf.reshape(x, prefix + [a * b])
   x_shape = common_layers.shape_list(x)
   a, b = x_shape[-2:]
   return tf.reshape(x, x_shape[:-2] + [a * b])
@@ -1192,6 +1446,13 @@ def combine_first_two_dimensions(x):
   Returns:
     a Tensor with shape [ab, ...]
   """
+  static_shape = x.get_shape().as_list()
+  if None not in static_shape[2:]:
+    # Trailing dims known at graph construction: plain Python-int reshape,
+    # no shape ops in the graph.
+    a, b = static_shape[:2]
+    first = a * b if a is not None and b is not None else -1
+    return tf.reshape(x, [first] + static_shape[2:])
   ret = tf.reshape(x, tf.concat([[-1], common_layers.shape_list(x)[2:]], 0))
   old_shape = x.get_shape().dims
   a, b = old_shape[:2]
@@ -1301,32 +1562,39 @@ def attention_image_summary(attn, image_shapes=None):
          memory_rows, memory_cols, memory_channels).
   """
   attn = tf.cast(attn, tf.float32)
-  num_heads = common_layers.shape_list(attn)[1]
-  # [batch, query_length, memory_length, num_heads]
-  image = tf.transpose(attn, [0, 2, 3, 1])
-  image = tf.pow(image, 0.2)  # for high-dynamic-range
+  batch, num_heads, query_length, memory_length = common_layers.shape_list(
+      attn)
+  image = tf.pow(attn, 0.2)  # for high-dynamic-range
   # Each head will correspond to one of RGB.
   # pad the heads to be a multiple of 3
-  image = tf.pad(image, [[0, 0], [0, 0], [0, 0], [0, tf.mod(-num_heads, 3)]])
-  image = split_last_dimension(image, 3)
-  image = tf.reduce_max(image, 4)
-  if image_shapes is not None:
-    if len(image_shapes) == 4:
-      q_rows, q_cols, m_rows, m_cols = list(image_shapes)
-      image = tf.reshape(image, [-1, q_rows, q_cols, m_rows, m_cols, 3])
-      image = tf.transpose(image, [0, 1, 3, 2, 4, 5])
-      image = tf.reshape(image, [-1, q_rows * m_rows, q_cols * m_cols, 3])
-    else:
-      assert len(image_shapes) == 6
-      q_rows, q_cols, q_channnels, m_rows, m_cols, m_channels = list(
-          image_shapes)
-      image = tf.reshape(
-          image,
-          [-1, q_rows, q_cols, q_channnels, m_rows, m_cols, m_channels, 3])
-      image = tf.transpose(image, [0, 1, 4, 3, 2, 5, 6, 7])
-      image = tf.reshape(
-          image,
-          [-1, q_rows * m_rows * q_channnels, q_cols * m_cols * m_channels, 3])
+  if not isinstance(num_heads, int):
+    image = tf.pad(image,
+                   [[0, 0], [0, tf.mod(-num_heads, 3)], [0, 0], [0, 0]])
+  elif num_heads % 3:
+    image = tf.pad(image, [[0, 0], [0, -num_heads % 3], [0, 0], [0, 0]])
+  # The max over each third of the heads is taken before moving the colors
+  # last, so only the 3-channel image is transposed, and only once.
+  # [batch, 3, query_length, memory_length]
+  image = tf.reduce_max(
+      tf.reshape(image, [batch, 3, -1, query_length, memory_length]), 2)
+  if image_shapes is None:
+    image = tf.transpose(image, [0, 2, 3, 1])
+  elif len(image_shapes) == 4:
+    q_rows, q_cols, m_rows, m_cols = list(image_shapes)
+    image = tf.reshape(image, [-1, 3, q_rows, q_cols, m_rows, m_cols])
+    image = tf.transpose(image, [0, 2, 4, 3, 5, 1])
+    image = tf.reshape(image, [-1, q_rows * m_rows, q_cols * m_cols, 3])
+  else:
+    assert len(image_shapes) == 6
+    q_rows, q_cols, q_channnels, m_rows, m_cols, m_channels = list(
+        image_shapes)
+    image = tf.reshape(
+        image,
+        [-1, 3, q_rows, q_cols, q_channnels, m_rows, m_cols, m_channels])
+    image = tf.transpose(image, [0, 2, 5, 4, 3, 6, 7, 1])
+    image = tf.reshape(
+        image,
+        [-1, q_rows * m_rows * q_channnels, q_cols * m_cols * m_channels, 3])
   tf.summary.image("attention", image, max_outputs=1)
 
 
@@ -1414,21 +1682,41 @@ def grouped_attention_multihead(query_antecedent,
     # We will train these by auxiliary losses.  We use stop_gradient here
     # to keep these losses from back-propagating to the rest of the model.
     # We add biases that help balance the usage of the experts.
-    q_pred = common_layers.dense(
-        tf.stop_gradient(query_antecedent),
-        num_heads * num_groups,
-        use_bias=False,
-        name="q_pred")
-    q_pred = split_heads(q_pred, num_heads)
-    q_bias = tf.get_variable("q_bias", [1, num_heads, 1, num_groups])
+    if query_antecedent is memory_antecedent:
+      # Self-attention: both predictors read the same input, so run a single
+      # matmul over the concatenated q_pred/m_pred kernels (same variables).
+      pred_input = tf.stop_gradient(query_antecedent)
+      input_depth = common_layers.shape_list(query_antecedent)[-1]
+      with tf.variable_scope("q_pred"):
+        q_pred_kernel = tf.get_variable(
+            "kernel", [input_depth, num_heads * num_groups])
+      q_bias = tf.get_variable("q_bias", [1, num_heads, 1, num_groups])
+      with tf.variable_scope("m_pred"):
+        m_pred_kernel = tf.get_variable(
+            "kernel", [input_depth, num_heads * num_groups])
+      m_bias = tf.get_variable("m_bias", [1, num_heads, 1, num_groups])
+      pred_kernel = common_layers.cast_like(
+          tf.concat([q_pred_kernel, m_pred_kernel], 1), pred_input)
+      pred = tf.tensordot(pred_input, pred_kernel, [[2], [0]])
+      q_pred, m_pred = tf.split(pred, 2, axis=2)
+      q_pred = split_heads(q_pred, num_heads)
+      m_pred = split_heads(m_pred, num_heads)
+    else:
+      q_pred = common_layers.dense(
+          tf.stop_gradient(query_antecedent),
+          num_heads * num_groups,
+          use_bias=False,
+          name="q_pred")
+      q_pred = split_heads(q_pred, num_heads)
+      q_bias = tf.get_variable("q_bias", [1, num_heads, 1, num_groups])
+      m_pred = common_layers.dense(
+          tf.stop_gradient(memory_antecedent),
+          num_heads * num_groups,
+          use_bias=False,
+          name="m_pred")
+      m_pred = split_heads(m_pred, num_heads)
+      m_bias = tf.get_variable("m_bias", [1, num_heads, 1, num_groups])
     q_pred_biased = q_pred + q_bias
-    m_pred = common_layers.dense(
-        tf.stop_gradient(memory_antecedent),
-        num_heads * num_groups,
-        use_bias=False,
-        name="m_pred")
-    m_pred = split_heads(m_pred, num_heads)
-    m_bias = tf.get_variable("m_bias", [1, num_heads, 1, num_groups])
     m_pred_biased = m_pred + m_bias
     q *= depth_qk**-0.5
     # q, kv, q_pred, m_pred are all [batch, heads, length_[q/m], ?]
@@ -1588,10 +1876,12 @@ def grouped_attention_multihead(query_antecedent,
 def harden_attention_weights(weights, k, gumbel_noise_weight):
   """Make attention weights non-0 only on the top k ones."""
   if gumbel_noise_weight > 0.:
-    gumbel_noise = -tf.log(-tf.log(tf.random_uniform(tf.shape(weights),
+    # Gumbel noise is -log(-log(u)); the outer negation is folded into the
+    # scale so the noise takes one elementwise pass less.
+    log_neg_log_u = tf.log(-tf.log(tf.random_uniform(tf.shape(weights),
                                                      minval=1e-5,
                                                      maxval=1 - 1e-5)))
-    weights += gumbel_noise * gumbel_noise_weight
+    weights -= log_neg_log_u * gumbel_noise_weight
 
   # Subtract the top-kth weight and zero-out all lower ones.
   # Note that currently in case of numerical ties it will retain more
@@ -1605,6 +1895,112 @@ def harden_attention_weights(weights, k, gumbel_noise_weight):
   return weights
 
 
+def _top_k_hard_attention_weights(logits, k):
+  """harden_attention_weights(softmax(logits), k) restricted to the top k.
+
+  The softmax is monotonic, so the top k weights are at the top k logits and
+  only their probabilities are computed.
+
+  Args:
+    logits: a Tensor with shape [..., length_q, length_kv].
+    k: a python integer, not larger than length_kv.
+
+  Returns:
+    weights: a Tensor with shape [..., length_q, k], the re-normalized weights.
+    indices: an int32 Tensor with shape [..., length_q, k], their positions.
+  """
+  top_logits, indices = tf.nn.top_k(logits, k)
+  weights = tf.exp(
+      top_logits - tf.reduce_logsumexp(logits, axis=-1, keepdims=True))
+  # The k-th weight becomes 0; the relu also stops its gradient, as in
+  # harden_attention_weights.
+  weights = tf.nn.relu(weights - tf.stop_gradient(weights[..., -1:]))
+  weights_sum = tf.reduce_sum(weights, axis=-1, keepdims=True)
+  weights_sum = tf.maximum(weights_sum, 1e-6)  # Avoid division by 0.
+  return weights / weights_sum, indices
+
+
+def _blockwise_dot_product_attention(q, k, v, bias, kv_block_size,
+                                     dropout_rate=0.0,
+                                     dropout_broadcast_dims=None,
+                                     softmax_dtype=tf.float32,
+                                     causal=False):
+  """softmax(QK^T + bias)V over blocks of the memory with an online softmax.
+
+  Only [..., length_q, kv_block_size] logits are live at a time: each block
+  updates a running max, normalizer and output, which are rescaled whenever
+  the max grows.
+
+  Args:
+    q: Tensor with shape [..., length_q, depth_k].
+    k: Tensor with shape [..., length_kv, depth_k]. length_kv must be static.
+    v: Tensor with shape [..., length_kv, depth_v].
+    bias: optional bias Tensor broadcastable to [..., length_q, length_kv].
+    kv_block_size: an integer, the number of memory positions per block.
+    dropout_rate: a float.
+    dropout_broadcast_dims: an optional list of integers less than rank of q.
+    softmax_dtype: dtype of the logits, normalizer and accumulated output.
+    causal: a boolean, see dot_product_attention. The mask is built per block.
+
+  Returns:
+    Tensor with shape [..., length_q, depth_v] and the dtype of v.
+  """
+  length_q = common_layers.shape_list(q)[-2]
+  length_kv = common_layers.shape_list(k)[-2]
+  # Slice the bias per block unless its memory dimension is statically 1; a
+  # dynamic last dimension is assumed to be length_kv.
+  slice_bias = bias is not None and (
+      bias.shape.ndims is None or bias.shape.as_list()[-1] != 1)
+  running_max = normalizer = output = None
+  for start in range(0, length_kv, kv_block_size):
+    end = min(start + kv_block_size, length_kv)
+    logits = tf.cast(
+        tf.matmul(q, k[..., start:end, :], transpose_b=True), softmax_dtype)
+    if bias is not None:
+      block_bias = bias[..., start:end] if slice_bias else bias
+      logits += common_layers.cast_like(block_bias, logits)
+    if causal:
+      logits += common_layers.cast_like(
+          _causal_bias(length_q, length_kv, start, end), logits)
+    block_max = tf.reduce_max(logits, axis=-1, keepdims=True)
+    new_max = (block_max if running_max is None
+               else tf.maximum(running_max, block_max))
+    weights = tf.exp(logits - new_max)
+    block_normalizer = tf.reduce_sum(weights, axis=-1, keepdims=True)
+    # Dropout commutes with the normalization, so it can be applied to the
+    # unnormalized weights of each block.
+    if dropout_rate:
+      weights = common_layers.dropout_with_broadcast_dims(
+          weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
+    block_output = tf.cast(
+        tf.matmul(common_layers.cast_like(weights, v), v[..., start:end, :]),
+        softmax_dtype)
+    if running_max is None:
+      normalizer, output = block_normalizer, block_output
+    else:
+      rescale = tf.exp(running_max - new_max)
+      normalizer = normalizer * rescale + block_normalizer
+      output = output * rescale + block_output
+    running_max = new_max
+  return tf.cast(output / normalizer, v.dtype)
+
+
+def _causal_bias(length_q, length_kv, start=0, end=None):
+  """Causal bias for memory positions [start, end) as [length_q, end - start].
+
+  The queries are aligned with the end of the memory, i.e. query i is at
+  memory position i + length_kv - length_q.
+  """
+  end = length_kv if end is None else end
+  if all(isinstance(d, int) for d in (length_q, length_kv, start, end)):
+    q_pos = np.arange(length_q)[:, None] + (length_kv - length_q)
+    m_pos = np.arange(start, end)[None, :]
+    return tf.constant(-1e9 * (m_pos > q_pos), tf.float32)
+  q_pos = tf.expand_dims(tf.range(length_q) + (length_kv - length_q), 1)
+  m_pos = tf.expand_dims(tf.range(start, end), 0)
+  return -1e9 * to_float(tf.greater(m_pos, q_pos))
+
+
 def dot_product_attention(q,
                           k,
                           v,
@@ -1618,7 +2014,11 @@ def dot_product_attention(q,
                           activation_dtype=None,
                           weight_dtype=None,
                           hard_attention_k=0,
-                          gumbel_noise_weight=0.0):
+                          gumbel_noise_weight=0.0,
+                          qkv_compute_dtype=None,
+                          softmax_dtype=None,
+                          kv_block_size=None,
+                          causal=False):
   """Dot-product attention.
 
   Args:
@@ -1645,18 +2045,67 @@ def dot_product_attention(q,
     gumbel_noise_weight: if > 0, apply Gumbel noise with weight
       `gumbel_noise_weight` before picking top-k. This is a no op if
       hard_attention_k <= 0.
+    qkv_compute_dtype: optional dtype q, k and v are cast to for the two
+      matmuls. The output is cast back to the dtype of q.
+    softmax_dtype: optional dtype the logits are cast to before the softmax.
+    kv_block_size: optional integer. If set and length_kv is static and
+      longer, attend to blocks of kv_block_size memory positions at a time
+      with an online softmax, so the full [length_q, length_kv] logits are
+      never materialized. Not used when the attention weights are needed
+      (save_weights_to, hard attention or image summaries).
+    causal: a boolean. If True, a query cannot attend to memory positions
+      after its own, with the queries aligned to the end of the memory. This
+      is the same mask as attention_bias_lower_triangle, but the blockwise
+      path only builds it per block. It is combined with bias if both given.
 
   Returns:
     Tensor with shape [..., length_q, depth_v].
   """
   with tf.variable_scope(
       name, default_name="dot_product_attention", values=[q, k, v]) as scope:
+    output_dtype = q.dtype
+    if qkv_compute_dtype is not None:
+      q, k, v = [tf.cast(t, qkv_compute_dtype) for t in (q, k, v)]
+    length_kv = common_layers.shape_list(k)[-2]
+    if (kv_block_size and isinstance(length_kv, int) and
+        length_kv > kv_block_size and save_weights_to is None and
+        hard_attention_k <= 0 and
+        not (common_layers.should_generate_summaries() and
+             make_image_summary)):
+      if softmax_dtype is None:
+        softmax_dtype = (
+            tf.float32 if mixed_precision_is_enabled(
+                activation_dtype, weight_dtype) else q.dtype)
+      return tf.cast(_blockwise_dot_product_attention(
+          q, k, v, bias, kv_block_size,
+          dropout_rate=dropout_rate,
+          dropout_broadcast_dims=dropout_broadcast_dims,
+          softmax_dtype=softmax_dtype,
+          causal=causal), output_dtype)
+    if causal:
+      causal_bias = _causal_bias(common_layers.shape_list(q)[-2], length_kv)
+      bias = causal_bias if bias is None else bias + causal_bias
     logits = tf.matmul(q, k, transpose_b=True)  # [..., length_q, length_kv]
+    if softmax_dtype is not None:
+      logits = tf.cast(logits, softmax_dtype)
     if bias is not None:
       bias = common_layers.cast_like(bias, logits)
       logits += bias
     # If logits are fp16, upcast before softmax
     logits = maybe_upcast(logits, activation_dtype, weight_dtype)
+    if (hard_attention_k > 0 and isinstance(length_kv, int) and
+        hard_attention_k <= length_kv and gumbel_noise_weight <= 0. and
+        not dropout_rate and save_weights_to is None and
+        not (common_layers.should_generate_summaries() and
+             make_image_summary)):
+      # Only the top-k weights are non-zero: attend to the gathered values
+      # instead of building the dense weights.
+      weights, top_indices = _top_k_hard_attention_weights(
+          logits, hard_attention_k)
+      weights = common_layers.cast_like(weights, q)
+      top_v = tf.gather(v, top_indices, axis=-2, batch_dims=v.shape.ndims - 2)
+      output = tf.matmul(tf.expand_dims(weights, -2), top_v)
+      return tf.cast(tf.squeeze(output, -2), output_dtype)
     weights = tf.nn.softmax(logits, name="attention_weights")
     if hard_attention_k > 0:
       weights = harden_attention_weights(weights, hard_attention_k,
@@ -1666,17 +2115,38 @@ def dot_product_attention(q,
       save_weights_to[scope.name] = weights
       save_weights_to[scope.name + "/logits"] = logits
     # Drop out attention links for each head.
-    weights = common_layers.dropout_with_broadcast_dims(
-        weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
+    if dropout_rate:
+      weights = common_layers.dropout_with_broadcast_dims(
+          weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
     if common_layers.should_generate_summaries() and make_image_summary:
       attention_image_summary(weights, image_shapes)
-    return tf.matmul(weights, v)
+    return tf.cast(tf.matmul(weights, v), output_dtype)
+
+
+@functools.lru_cache(maxsize=32)
+def _generate_relative_positions_matrix_np(length_q, length_k,
+                                           max_relative_position, cache):
+  """NumPy version of _generate_relative_positions_matrix for static lengths."""
+  if not cache:
+    range_vec_k = np.arange(length_k, dtype=np.int32)
+    range_vec_q = range_vec_k[-length_q:]
+    distance_mat = range_vec_k[None, :] - range_vec_q[:, None]
+  else:
+    distance_mat = np.arange(-length_k + 1, 1, dtype=np.int32)[None, :]
+  return np.clip(distance_mat, -max_relative_position,
+                 max_relative_position) + max_relative_position
 
 
 def _generate_relative_positions_matrix(length_q, length_k,
                                         max_relative_position,
                                         cache=False):
   """Generates matrix of relative positions between inputs."""
+  if (isinstance(length_q, int) and isinstance(length_k, int) and
+      isinstance(max_relative_position, int)):
+    # The index matrix only depends on the static lengths: build it once as a
+    # constant instead of a range/subtract/clip chain per layer.
+    return tf.constant(_generate_relative_positions_matrix_np(
+        length_q, length_k, max_relative_position, bool(cache)))
   if not cache:
     if length_q == length_k:
       range_vec_q = range_vec_k = tf.range(length_q)
@@ -1723,23 +2193,16 @@ def _relative_attention_inner(x, y, z, transpose):
   Returns:
     A Tensor with shape [batch_size, heads, length, length or depth].
   """
-  batch_size = tf.shape(x)[0]
-  heads = x.get_shape().as_list()[1]
-  length = tf.shape(x)[2]
-
   # xy_matmul is [batch_size, heads, length or 1, length or depth]
   xy_matmul = tf.matmul(x, y, transpose_b=transpose)
-  # x_t is [length or 1, batch_size, heads, length or depth]
-  x_t = tf.transpose(x, [2, 0, 1, 3])
-  # x_t_r is [length or 1, batch_size * heads, length or depth]
-  x_t_r = tf.reshape(x_t, [length, heads * batch_size, -1])
-  # x_tz_matmul is [length or 1, batch_size * heads, length or depth]
-  x_tz_matmul = tf.matmul(x_t_r, z, transpose_b=transpose)
-  # x_tz_matmul_r is [length or 1, batch_size, heads, length or depth]
-  x_tz_matmul_r = tf.reshape(x_tz_matmul, [length, batch_size, heads, -1])
-  # x_tz_matmul_r_t is [batch_size, heads, length or 1, length or depth]
-  x_tz_matmul_r_t = tf.transpose(x_tz_matmul_r, [1, 2, 0, 3])
-  return xy_matmul + x_tz_matmul_r_t
+  # x_tz_matmul is [batch_size, heads, length or 1, length or depth]. The
+  # contraction is batched over the query position, which einsum handles
+  # without the explicit transpose/reshape round trip.
+  if transpose:
+    x_tz_matmul = tf.einsum("bhld,lmd->bhlm", x, z)
+  else:
+    x_tz_matmul = tf.einsum("bhlm,lmd->bhld", x, z)
+  return xy_matmul + x_tz_matmul
 
 
 def dot_product_attention_relative(q,
@@ -1825,7 +2288,8 @@ def dot_product_attention_relative(q,
     if save_weights_to is not None:
       save_weights_to[scope.name] = weights
       save_weights_to[scope.name + "/logits"] = logits
-    weights = tf.nn.dropout(weights, 1.0 - dropout_rate)
+    if dropout_rate:
+      weights = tf.nn.dropout(weights, 1.0 - dropout_rate)
     if (not tf.get_variable_scope().reuse and
         common_layers.should_generate_summaries() and
         make_image_summary):
@@ -1833,6 +2297,35 @@ def dot_product_attention_relative(q,
     return _relative_attention_inner(weights, v, relations_values, False)
 
 
+@functools.lru_cache(maxsize=32)
+def _relative_position_masked_indices_np(length, to_absolute):
+  """Flat gather indices of the masked relative/absolute position skews.
+
+  Args:
+    length: an integer.
+    to_absolute: a boolean, True for relative to absolute positions.
+
+  Returns:
+    an int32 array of shape [length, length] indexing into the flattened
+    [length * length] input.
+  """
+  idx = np.arange(length * length, dtype=np.int32).reshape(length, length)
+  if to_absolute:
+    idx = np.pad(idx, [[0, 0], [1, 0]], constant_values=-1)
+    idx = idx.reshape(1 + length, length)[1:]
+  else:
+    idx = np.pad(idx, [[1, 0], [0, 0]], constant_values=-1)
+    idx = idx.reshape(length, length + 1)[:, 1:]
+  # The padding only lands on positions which are masked out. Read the
+  # (0, length - 1) input there instead: it is in the masked region of the
+  # input, i.e. a zero attention weight.
+  return np.where(idx < 0, length - 1, idx)
+
+
+def _relative_position_masked_indices(length, to_absolute):
+  return tf.constant(_relative_position_masked_indices_np(length, to_absolute))
+
+
 def _relative_position_to_absolute_position_masked(x):
   """Helper to dot_product_self_attention_relative_v2.
 
@@ -1854,6 +2347,11 @@ def _relative_position_to_absolute_position_masked(x):
     a Tensor with shape [batch, heads, length, length]
   """
   batch, heads, length, _ = common_layers.shape_list(x)
+  if isinstance(length, int):
+    # One gather instead of the pad + slice copies.
+    x = tf.reshape(x, [batch, heads, length * length])
+    return tf.gather(
+        x, _relative_position_masked_indices(length, to_absolute=True), axis=2)
   x = tf.pad(x, [[0, 0], [0, 0], [0, 0], [1, 0]])
   x = tf.reshape(x, [batch, heads, 1 + length, length])
   x = tf.slice(x, [0, 0, 1, 0], [-1, -1, -1, -1])
@@ -1881,6 +2379,12 @@ def _absolute_position_to_relative_position_masked(x):
     a Tensor with shape [batch, heads, length, length]
   """
   batch, heads, length, _ = common_layers.shape_list(x)
+  if isinstance(length, int):
+    # One gather instead of the pad + slice copies.
+    x = tf.reshape(x, [batch, heads, length * length])
+    return tf.gather(
+        x, _relative_position_masked_indices(length, to_absolute=False),
+        axis=2)
   x = tf.pad(x, [[0, 0], [0, 0], [1, 0], [0, 0]])
   x = tf.reshape(x, [batch, heads, length, length + 1])
   x = tf.slice(x, [0, 0, 0, 1], [batch, heads, length, length])
@@ -1917,6 +2421,13 @@ def get_relative_embeddings_left(max_relative_position, length, depth,
   relative_embeddings = tf.get_variable(
       name=name, shape=embedding_shape,
       initializer=tf.random_normal_initializer(stddev=initializer_stddev))
+  if isinstance(length, int) and isinstance(max_relative_position, int):
+    # Static lengths: only one of the pad or the slice is actually needed.
+    if length <= max_relative_position:
+      return relative_embeddings[..., max_relative_position - length:, :]
+    paddings = [[0, 0]] * (len(embedding_shape) - 2) + [
+        [length - max_relative_position, 0], [0, 0]]
+    return tf.pad(relative_embeddings, paddings)
   # Pad first before slice to avoid using tf.cond.
   pad_length = tf.maximum(length - max_relative_position, 0)
   start_slice_position = tf.maximum(max_relative_position - length, 0)
@@ -2020,8 +2531,9 @@ def dot_product_self_attention_relative_v2(q,
       save_weights_to[scope.name] = weights
       save_weights_to[scope.name + "/logits"] = logits
     # Dropping out the attention links for each of the heads.
-    weights = common_layers.dropout_with_broadcast_dims(
-        weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
+    if dropout_rate:
+      weights = common_layers.dropout_with_broadcast_dims(
+          weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
     if common_layers.should_generate_summaries() and make_image_summary:
       attention_image_summary(weights, image_shapes)
     output = tf.matmul(weights, v)
@@ -2038,6 +2550,25 @@ def dot_product_self_attention_relative_v2(q,
     return output
 
 
+@functools.lru_cache(maxsize=32)
+def _absolute_to_relative_unmasked_indices_np(length):
+  """Flat gather indices of the unmasked absolute to relative position skew.
+
+  Args:
+    length: an integer.
+
+  Returns:
+    indices: an int32 array of shape [length, 2 * length - 1] indexing into
+      the flattened [length * length] input.
+    valid: a float32 array of the same shape, 0 where the skew reads padding.
+  """
+  idx = np.arange(length * length, dtype=np.int32).reshape(length, length)
+  idx = np.pad(idx, [[0, 0], [0, length - 1]], constant_values=-1)
+  idx = np.pad(idx.reshape(-1), [[length, 0]], constant_values=-1)
+  idx = idx.reshape(length, 2 * length)[:, 1:]
+  return np.maximum(idx, 0), (idx >= 0).astype(np.float32)
+
+
 def _absolute_position_to_relative_position_unmasked(x):
   """Helper function for dot_product_unmasked_self_attention_relative_v2.
 
@@ -2058,6 +2589,13 @@ def _absolute_position_to_relative_position_unmasked(x):
     a Tensor with shape [batch, heads, length, 2*length-1]
   """
   batch, heads, length, _ = common_layers.shape_list(x)
+  if isinstance(length, int):
+    # One gather and a multiply by the constant validity mask, instead of
+    # the two pads and the slice.
+    indices, valid = _absolute_to_relative_unmasked_indices_np(length)
+    x = tf.reshape(x, [batch, heads, length * length])
+    x = tf.gather(x, tf.constant(indices), axis=2)
+    return x * common_layers.cast_like(tf.constant(valid), x)
   # padd along column
   x = tf.pad(x, [[0, 0], [0, 0], [0, 0], [0, length-1]])
   x_flat = tf.reshape(x, [batch, heads, length**2 + length*(length -1)])
@@ -2101,6 +2639,15 @@ def get_relative_embeddings_left_right(max_relative_position, length, depth,
   relative_embeddings = tf.get_variable(
       name=name, shape=embedding_shape,
       initializer=tf.random_normal_initializer(stddev=initializer_stddev))
+  if isinstance(length, int) and isinstance(max_relative_position, int):
+    # Static lengths: only one of the pad or the slice is actually needed.
+    if length <= max_relative_position:
+      start = max_relative_position - length
+      return relative_embeddings[..., start:start + 2 * length - 1, :]
+    pad_length = length - max_relative_position
+    paddings = [[0, 0]] * (len(embedding_shape) - 2) + [
+        [pad_length, pad_length], [0, 0]]
+    return tf.pad(relative_embeddings, paddings)
   # Pad first before slice to avoid using tf.cond.
   pad_length = tf.maximum(length - max_relative_position, 0)
   slice_start_position = tf.maximum(max_relative_position-length, 0)
@@ -2198,8 +2745,9 @@ def dot_product_unmasked_self_attention_relative_v2(
       save_weights_to[scope.name] = weights
       save_weights_to[scope.name + "/logits"] = logits
     # dropping out the attention links for each of the heads
-    weights = common_layers.dropout_with_broadcast_dims(
-        weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
+    if dropout_rate:
+      weights = common_layers.dropout_with_broadcast_dims(
+          weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
     # relative_weights.set_shape([None, None, None, max_length])
     if common_layers.should_generate_summaries() and make_image_summary:
       attention_image_summary(weights, image_shapes)
@@ -2221,11 +2769,15 @@ def dot_product_unmasked_self_attention_relative_v2(
 
 def _matmul_with_relative_keys_2d(x, y, heads_share_relative_embedding):
   """Helper function for dot_product_unmasked_self_attention_relative_2d."""
-  if heads_share_relative_embedding:
-    ret = tf.einsum("bhxyd,md->bhxym", x, y)
-  else:
-    ret = tf.einsum("bhxyd,hmd->bhxym", x, y)
-  return ret
+  # Fold the two spatial dimensions into the rows of a batched matmul over
+  # [batch, heads]. y [m, d] or [heads, m, d] is broadcast over the leading
+  # dims, so x needs no transpose and y is not tiled.
+  del heads_share_relative_embedding  # Given by the rank of y.
+  batch, heads, height, width, depth = common_layers.shape_list(x)
+  x = tf.reshape(x, [batch, heads, height * width, depth])
+  ret = tf.matmul(x, y, transpose_b=True)
+  return tf.reshape(
+      ret, [batch, heads, height, width, common_layers.shape_list(y)[-2]])
 
 
 def dot_product_unmasked_self_attention_relative_2d(
@@ -2313,20 +2865,15 @@ def dot_product_unmasked_self_attention_relative_2d(
       unmasked_rel_logits = (
           _relative_position_to_absolute_position_unmasked(
               unmasked_rel_logits))
-      # shape it back for tiling
+      # shape it back for broadcasting
       unmasked_rel_logits = tf.reshape(
           unmasked_rel_logits, [-1, num_heads, height, width, width])
-      # tiling it height times
+      # add a unit dimension in place of tiling it height times; the add
+      # against the 6d logits broadcasts over it.
       unmasked_rel_logits = tf.expand_dims(
           unmasked_rel_logits, axis=3)
-      unmasked_rel_logits = tf.tile(unmasked_rel_logits,
-                                    [1, 1, 1, height, 1, 1])
       # bringing it to the right shape for adding to the logits.
-      unmasked_rel_logits = tf.transpose(unmasked_rel_logits, transpose_mask)
-      unmasked_rel_logits = tf.reshape(unmasked_rel_logits,
-                                       [-1, num_heads, height*width,
-                                        height*width])
-      return unmasked_rel_logits
+      return tf.transpose(unmasked_rel_logits, transpose_mask)
 
     # Relative logits in width dimension first.
     width_key_relative_embeddings = get_relative_embeddings_left_right(
@@ -2337,7 +2884,6 @@ def dot_product_unmasked_self_attention_relative_2d(
     width_unmasked_rel_logits = _compute_2d_relative_logits(
         q, width_key_relative_embeddings, height, width,
         heads_share_relative_embedding, [0, 1, 2, 4, 3, 5])
-    logits += width_unmasked_rel_logits
     # Relative logits in height dimension next. For ease, we transpose
     # height and width and repeat the above steps, and transpose to eventually
     # put the logits in their right positions.
@@ -2353,13 +2899,17 @@ def dot_product_unmasked_self_attention_relative_2d(
         width,
         height,
         heads_share_relative_embedding, [0, 1, 4, 2, 5, 3])
-    logits += height_unmasked_rel_logits
+    # [batch, heads, height, width, height, width]
+    logits = tf.reshape(logits, [-1, num_heads, height, width, height, width])
+    logits += width_unmasked_rel_logits + height_unmasked_rel_logits
+    logits = tf.reshape(logits, [-1, num_heads, height*width, height*width])
     if bias is not None:
       logits += bias
     weights = tf.nn.softmax(logits, name="attention_weights")
     # dropping out the attention links for each of the heads
-    weights = common_layers.dropout_with_broadcast_dims(
-        weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
+    if dropout_rate:
+      weights = common_layers.dropout_with_broadcast_dims(
+          weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
     if common_layers.should_generate_summaries() and make_image_summary:
       attention_image_summary(weights, image_shapes)
     ret = tf.matmul(weights, flatten_hw(v, depth_v))
@@ -2399,14 +2949,9 @@ def _split_along_width(x_left_right_blocks):
                                     x_memory_flange_h,
                                     x_memory_flange_w, depth])
 
-  x_left_blocks, x_right_blocks = tf.split(x_left_right_blocks,
-                                           num_or_size_splits=2, axis=3)
-  x_left_blocks = tf.squeeze(x_left_blocks, axis=3)
-  x_right_blocks = tf.squeeze(x_right_blocks, axis=3)
-  x_left_blocks = tf.slice(x_left_blocks, [0, 0, 0, 0, 0, 0],
-                           [-1, -1, x_num_w_blocks, -1, -1, -1])
-  x_right_blocks = tf.slice(x_right_blocks, [0, 0, 1, 0, 0, 0],
-                            [-1, -1, x_num_w_blocks, -1, -1, -1])
+  # a single strided slice per side picks the block and squeezes the pair axis
+  x_left_blocks = x_left_right_blocks[:, :, :x_num_w_blocks, 0]
+  x_right_blocks = x_left_right_blocks[:, :, 1:x_num_w_blocks+1, 1]
   return x_left_blocks, x_right_blocks
 
 
@@ -2576,15 +3121,14 @@ def get_2d_local_memory_v2(x, query_shape, memory_flange):
   num_w_memory_blocks = width//query_shape[1] + 1
   x_memory_blocks = _extract_blocks(padded_x,
                                     query_shape[0], query_shape[1])
-  x_width_blocks = tf.split(x_memory_blocks, num_w_memory_blocks,
-                            2)
-  x_left_width = tf.concat(x_width_blocks[:num_w_memory_blocks - 1], axis=2)
-  x_right_width = tf.concat(x_width_blocks[1:], axis=2)
+  # pair every block with its right (resp. bottom) neighbour by slicing the
+  # block axis once rather than splitting it into single blocks.
+  x_left_width = x_memory_blocks[:, :, :num_w_memory_blocks - 1]
+  x_right_width = x_memory_blocks[:, :, 1:]
   x_memory_blocks = tf.concat([x_left_width, x_right_width], axis=4)
 
-  x_height_blocks = tf.split(x_memory_blocks, num_h_memory_blocks, 1)
-  x_top_height = tf.concat(x_height_blocks[:num_h_memory_blocks - 1], axis=1)
-  x_bottom_height = tf.concat(x_height_blocks[1:], axis=1)
+  x_top_height = x_memory_blocks[:, :num_h_memory_blocks - 1]
+  x_bottom_height = x_memory_blocks[:, 1:]
   x = tf.concat([x_top_height, x_bottom_height], axis=3)
 
   return x
@@ -2593,7 +3137,7 @@ def get_2d_local_memory_v2(x, query_shape, memory_flange):
 def dot_product_unmasked_attention_local_2d_tpu(
     q, k, v, bias, max_relative_position=None, query_shape=(8, 8),
     dropout_rate=0.0, image_shapes=None, name=None, make_image_summary=False,
-    dropout_broadcast_dims=None):
+    dropout_broadcast_dims=None, qkv_compute_dtype=None, softmax_dtype=None):
   """Calculate unmasked dot-product local self-attention 2d on tpu.
 
   Args:
@@ -2611,6 +3155,9 @@ def dot_product_unmasked_attention_local_2d_tpu(
     dropout_broadcast_dims:  an optional list of integers less than 4
       specifying in which dimensions to broadcast the dropout decisions.
       saves memory.
+    qkv_compute_dtype: optional dtype q, k and v are cast to for the two
+      matmuls. The output is cast back to the dtype of q.
+    softmax_dtype: optional dtype the logits are cast to before the softmax.
 
   Returns:
     [batch, heads, height, width, depth] tensor, the output of attention.
@@ -2628,6 +3175,9 @@ def dot_product_unmasked_attention_local_2d_tpu(
     # q, k and v must therefore have the same shape.
     q.get_shape().assert_is_compatible_with(k.get_shape())
     q.get_shape().assert_is_compatible_with(v.get_shape())
+    output_dtype = q.dtype
+    if qkv_compute_dtype is not None:
+      q, k, v = [tf.cast(t, qkv_compute_dtype) for t in (q, k, v)]
     orig_q_shape = common_layers.shape_list(q)
     # Pad query, key, value to ensure multiple of corresponding lengths.
     memory_flange = [int(query_shape[0]//2), int(query_shape[1]//2)]
@@ -2660,33 +3210,39 @@ def dot_product_unmasked_attention_local_2d_tpu(
     values = tf.reshape(values, [-1, num_heads, num_h_blocks, num_w_blocks,
                                  memory_h*memory_w, depth_v])
     logits = tf.matmul(queries, keys, transpose_b=True)
+    if softmax_dtype is not None:
+      logits = tf.cast(logits, softmax_dtype)
     if bias is not None:
-      logits += bias
+      logits += common_layers.cast_like(bias, logits)
 
     weights = tf.nn.softmax(logits, name="attention_weights")
+    weights = common_layers.cast_like(weights, values)
     # Dropping out the attention links for each of the heads
-    weights = common_layers.dropout_with_broadcast_dims(
-        weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
+    if dropout_rate:
+      weights = common_layers.dropout_with_broadcast_dims(
+          weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
     if common_layers.should_generate_summaries() and make_image_summary:
       attention_image_summary(weights, image_shapes)
-    ret = tf.matmul(weights, values)
-    # we need to get it back to shape [batch, heads, height, width]
-    ret = tf.reshape(ret, [-1, num_heads, num_h_blocks, num_w_blocks,
-                           query_shape[0], query_shape[1], depth_v])
-    ret = tf.transpose(ret, [0, 1, 2, 4, 3, 5, 6])
+    # we need to get it back to shape [batch, heads, height, width]; the
+    # einsum emits the blocks already interleaved with the query rows, so
+    # no separate un-blocking transpose is needed.
+    weights = tf.reshape(weights, [-1, num_heads, num_h_blocks, num_w_blocks,
+                                   query_shape[0], query_shape[1],
+                                   memory_h*memory_w])
+    ret = tf.einsum("bnhwijm,bnhwmd->bnhiwjd", weights, values)
     ret = tf.reshape(ret, [-1, num_heads, num_h_blocks*query_shape[0],
                            num_w_blocks*query_shape[1], depth_v])
     # slice if padding was introduced
     ret = tf.slice(ret, [0, 0, 0, 0, 0], [-1, -1, orig_q_shape[2],
                                           orig_q_shape[3], -1])
-    return ret
+    return tf.cast(ret, output_dtype)
 
 
 def dot_product_unmasked_attention_local_2d_tpu_simple(
     x, bias, total_key_depth, total_value_depth, num_heads,
     query_shape=(8, 8),
     dropout_rate=0.0, image_shapes=None, make_image_summary=False,
-    dropout_broadcast_dims=None):
+    dropout_broadcast_dims=None, qkv_compute_dtype=None, softmax_dtype=None):
 
   """Calculate simple unmasked dot-product local self-attention 2d on tpu.
 
@@ -2706,6 +3262,9 @@ def dot_product_unmasked_attention_local_2d_tpu_simple(
     dropout_broadcast_dims:  an optional list of integers less than 4
       specifying in which dimensions to broadcast the dropout decisions.
       saves memory.
+    qkv_compute_dtype: optional dtype q, k and v are cast to for the two
+      matmuls. The output is cast back to the dtype of the projections.
+    softmax_dtype: optional dtype the logits are cast to before the softmax.
 
   Returns:
     ret: [batch, height, width, total_value_depth] tensor,
@@ -2735,22 +3294,30 @@ def dot_product_unmasked_attention_local_2d_tpu_simple(
   q, k, v = compute_qkv(x_blocks, None, total_key_depth, total_value_depth)
   hsplit = lambda x: split_heads(x, num_heads)
   q, k, v = map(hsplit, [q, k, v])
-  logits = tf.matmul(q, k, transpose_b=True)
+  if qkv_compute_dtype is not None:
+    q_c, k_c, v_c = [tf.cast(t, qkv_compute_dtype) for t in (q, k, v)]
+  else:
+    q_c, k_c, v_c = q, k, v
+  logits = tf.matmul(q_c, k_c, transpose_b=True)
+  if softmax_dtype is not None:
+    logits = tf.cast(logits, softmax_dtype)
   if bias is not None:
-    logits += bias
+    logits += common_layers.cast_like(bias, logits)
   weights = tf.nn.softmax(logits, name="attention_weights")
+  weights = common_layers.cast_like(weights, v_c)
   # Dropping out the attention links for each of the heads
-  weights = common_layers.dropout_with_broadcast_dims(
-      weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
+  if dropout_rate:
+    weights = common_layers.dropout_with_broadcast_dims(
+        weights, 1.0 - dropout_rate, broadcast_dims=dropout_broadcast_dims)
   if common_layers.should_generate_summaries() and make_image_summary:
     attention_image_summary(weights, image_shapes)
-  output = tf.matmul(weights, v)
-  output = combine_heads(output)
-  # we need to get it back to shape [batch, height, width]
-  ret = tf.reshape(output, [-1, num_h_blocks, num_w_blocks,
-                            query_shape[0], query_shape[1], total_value_depth])
-
-  ret = tf.transpose(ret, [0, 1, 3, 2, 4, 5])
+  output = tf.cast(tf.matmul(weights, v_c), v.dtype)
+  # we need to get it back to shape [batch, height, width]; combining the
+  # heads and un-blocking are folded into a single transpose.
+  ret = tf.reshape(output, [-1, num_h_blocks, num_w_blocks, num_heads,
+                            query_shape[0], query_shape[1],
+                            total_value_depth // num_heads])
+  ret = tf.transpose(ret, [0, 1, 4, 2, 5, 3, 6])
   ret = tf.reshape(ret, [-1, num_h_blocks*query_shape[0],
                          num_w_blocks*query_shape[1], total_value_depth])
   # slice if padding was introduced
@@ -2802,8 +3369,7 @@ def masked_within_block_local_attention_1d(q, k, v, block_length=64, name=None):
     v = tf.reshape(v, [batch, heads, num_blocks, block_length, depth_v])
     # [batch, heads, num_blocks, block_length, block_length]
     attention = tf.matmul(q, k, transpose_b=True)
-    attention += tf.reshape(attention_bias_lower_triangle(block_length),
-                            [1, 1, 1, block_length, block_length])
+    attention += _attention_bias_band(block_length, block_length, -1, 0, 5)
     attention = tf.nn.softmax(attention)
     # [batch, heads, num_blocks, block_length, depth_v]
     output = tf.matmul(attention, v)
@@ -2830,19 +3396,16 @@ def _relative_position_to_absolute_position_unmasked(x):
   batch = x_shape[0]
   heads = x_shape[1]
   length = x_shape[2]
-  # Concat columns of pad to shift from relative to absolute indexing.
-  col_pad = tf.zeros((batch, heads, length, 1))
-  x = tf.concat([x, col_pad], axis=3)
+  # Pad a column to shift from relative to absolute indexing.
+  x = tf.pad(x, [[0, 0], [0, 0], [0, 0], [0, 1]])
 
-  # Concat extra elements so to add up to shape (len+1, 2*len-1).
+  # Pad extra elements so to add up to shape (len+1, 2*len-1).
   flat_x = tf.reshape(x, [batch, heads, length * 2 * length])
-  flat_pad = tf.zeros((batch, heads, length-1))
-  flat_x_padded = tf.concat([flat_x, flat_pad], axis=2)
+  flat_x_padded = tf.pad(flat_x, [[0, 0], [0, 0], [0, length-1]])
 
   # Reshape and slice out the padded elements.
   final_x = tf.reshape(flat_x_padded, [batch, heads, length+1, 2*length-1])
-  final_x = final_x[:, :, :, length-1:]
-  final_x = final_x[:, :, :length, :]
+  final_x = tf.slice(final_x, [0, 0, 0, length-1], [-1, -1, length, length])
   return final_x
 
 
@@ -2900,56 +3463,45 @@ def masked_local_attention_1d(q,
     else:
       num_blocks = tf.div(length, block_length)
 
-    # Compute attention for the first query block.
-    first_q = tf.slice(q, [0, 0, 0, 0], [-1, -1, block_length, -1])
-    first_k = tf.slice(k, [0, 0, 0, 0], [-1, -1, block_length, -1])
-    first_v = tf.slice(v, [0, 0, 0, 0], [-1, -1, block_length, -1])
-
-    first_output = dot_product_attention(
-        first_q,
-        first_k,
-        first_v,
-        attention_bias_lower_triangle(block_length),
-        dropout_rate=dropout_rate,
-        make_image_summary=make_image_summary,
-        name="first_block")
-
-    # Compute attention for all subsequent query blocks.
+    # Compute attention for all query blocks at once. Each block attends to
+    # itself and the previous block; the first block gets a zero block in
+    # front that is masked out below.
     q = tf.reshape(q, [batch, heads, num_blocks, block_length, depth_k])
     k = tf.reshape(k, [batch, heads, num_blocks, block_length, depth_k])
     v = tf.reshape(v, [batch, heads, num_blocks, block_length, depth_v])
-
-    local_k = _make_local_block(k, depth_k, batch, heads, num_blocks,
-                                block_length)
-    local_v = _make_local_block(v, depth_v, batch, heads, num_blocks,
-                                block_length)
-    tail_q = tf.slice(q, [0, 0, 1, 0, 0], [-1, -1, -1, -1, -1])
-    tail_q = tf.reshape(tail_q,
-                        [batch, heads, num_blocks - 1, block_length, depth_k])
-    local_length = common_layers.shape_list(local_k)[3]
+    prev_block_padding = [[0, 0], [0, 0], [1, 0], [0, 0], [0, 0]]
+    local_k = tf.concat([tf.pad(k[:, :, :-1], prev_block_padding), k], 3)
+    local_v = tf.concat([tf.pad(v[:, :, :-1], prev_block_padding), v], 3)
+    local_length = 2 * block_length
 
     # make sure source_pos <= target_pos
-    good_part = common_layers.ones_matrix_band_part(
-        block_length,
-        local_length,
-        -1,
-        block_length,
-        out_shape=[1, 1, 1, block_length, local_length])
-    bias = (1.0 - good_part) * -1e9
-    # TODO(noam): figure out how to show a summary for the remaining blocks.
-    # The naive way currently causes errors due to empty tensors.
-    # output: [batch, heads, num_blocks-1, block_length, depth_v]
-    tail_output = dot_product_attention(
-        tail_q,
+    bias = _attention_bias_band(block_length, local_length, -1, block_length, 5)
+    # and that the first block does not see its (empty) previous block.
+    first_block_bias = tf.pad(
+        tf.fill([1, 1, 1, 1, block_length], -1e9),
+        [[0, 0], [0, 0], [0, num_blocks - 1], [0, 0], [0, block_length]])
+    bias = tf.minimum(bias, first_block_bias)
+    # The summary only covers the first block, as attention within the other
+    # blocks does not form a single image.
+    summarize = (
+        make_image_summary and common_layers.should_generate_summaries())
+    weights_to_summarize = {} if summarize else None
+    # output: [batch, heads, num_blocks, block_length, depth_v]
+    output = dot_product_attention(
+        q,
         local_k,
         local_v,
         bias,
         dropout_rate=dropout_rate,
         make_image_summary=False,
-        name="tail_block")
-    tail_output = tf.reshape(
-        tail_output, [batch, heads, (num_blocks - 1) * block_length, depth_v])
-    output = tf.concat([first_output, tail_output], axis=2)
+        save_weights_to=weights_to_summarize,
+        name="local_block")
+    if summarize:
+      weights = next(w for name, w in weights_to_summarize.items()
+                     if not name.endswith("/logits"))
+      attention_image_summary(weights[:, :, 0, :, block_length:])
+    output = tf.reshape(
+        output, [batch, heads, num_blocks * block_length, depth_v])
 
     # Remove the padding if introduced.
     output = tf.slice(output, [0, 0, 0, 0], [-1, -1, original_length, -1])
@@ -3061,9 +3613,10 @@ def masked_relative_local_attention_1d(q,
     first_att = tf.nn.softmax(first_logits,
                               name="first_attention_weights")
     # dropping out the attention links for each of the heads
-    first_att = common_layers.dropout_with_broadcast_dims(
-        first_att, 1.0 - dropout_rate,
-        broadcast_dims=None)
+    if dropout_rate:
+      first_att = common_layers.dropout_with_broadcast_dims(
+          first_att, 1.0 - dropout_rate,
+          broadcast_dims=None)
     # only call image summary for the first block
     if common_layers.should_generate_summaries() and make_image_summary:
       attention_image_summary(first_att, None)
@@ -3114,18 +3667,15 @@ def masked_relative_local_attention_1d(q,
     all_logits = (
         tf.matmul(rel_tail_q, rel_k, transpose_b=True) + all_rel_logits)
     # make sure source_pos <= target_pos
-    good_part = common_layers.ones_matrix_band_part(block_length,
-                                                    local_length,
-                                                    -1, block_length)
-    mask = (1.0 - good_part) * -1e9
-    mask = common_layers.cast_like(mask, all_logits)
-    all_logits += tf.reshape(mask, [1, 1, block_length, local_length])
+    mask = _attention_bias_band(block_length, local_length, -1, block_length, 4)
+    all_logits += common_layers.cast_like(mask, all_logits)
     weights = tf.nn.softmax(all_logits, name="attention_weights")
     # [batch (* num_blocks), heads, query_length (=block_length),
     # key_length (=2*block_length)]
-    weights = common_layers.dropout_with_broadcast_dims(
-        weights, 1.0 - dropout_rate,
-        broadcast_dims=None)
+    if dropout_rate:
+      weights = common_layers.dropout_with_broadcast_dims(
+          weights, 1.0 - dropout_rate,
+          broadcast_dims=None)
 
     output = tf.matmul(weights, rel_v)
     if add_relative_to_values:
@@ -3299,6 +3849,171 @@ def local_attention_1d(q, k, v, block_length=128, filter_width=100, name=None):
     return output
 
 
+@functools.lru_cache(maxsize=32)
+def _block_sparse_local_lut_np(num_blocks, blocks_left, blocks_right):
+  """NumPy block LUT for block_sparse_local_lut with a static num_blocks."""
+  offsets = np.arange(-blocks_left, blocks_right + 1, dtype=np.int32)
+  indices = np.arange(num_blocks, dtype=np.int32)[:, None] + offsets[None, :]
+  mask = (indices >= 0) & (indices < num_blocks)
+  return np.clip(indices, 0, num_blocks - 1), mask
+
+
+def block_sparse_local_lut(num_blocks, blocks_left, blocks_right):
+  """Block lookup table for banded block-sparse attention.
+
+  Query block i attends to key/value blocks i - blocks_left ... i +
+  blocks_right. Every query block has the same number of slots; slots that
+  fall outside the sequence are clamped to a valid block and masked out.
+
+  Args:
+    num_blocks: an integer or scalar Tensor, the number of query (and
+      key/value) blocks.
+    blocks_left: an integer, how many blocks to look to the left.
+    blocks_right: an integer, how many blocks to look to the right.
+
+  Returns:
+    kv_block_indices: an int32 Tensor with shape
+      [num_blocks, blocks_left + 1 + blocks_right].
+    kv_block_mask: a bool Tensor with the same shape, False for padding slots.
+  """
+  if isinstance(num_blocks, int):
+    indices, mask = _block_sparse_local_lut_np(
+        num_blocks, blocks_left, blocks_right)
+    return tf.constant(indices), tf.constant(mask)
+  offsets = tf.range(-blocks_left, blocks_right + 1)
+  indices = tf.expand_dims(tf.range(num_blocks), 1) + offsets
+  mask = tf.logical_and(indices >= 0, indices < num_blocks)
+  return tf.clip_by_value(indices, 0, num_blocks - 1), mask
+
+
+def block_sparse_attention(q, k, v, lut, block_size, mask_right=False,
+                           filter_width=None, name=None):
+  """Block-sparse attention driven by a block lookup table.
+
+  The sequence is divided into blocks of length block_size. Each query block
+  only computes logits against the key/value blocks listed for it in lut,
+  so no [length, length] (or dense banded) logits tensor is materialized.
+
+  Args:
+    q: a Tensor with shape [batch, heads, length, depth_k]
+    k: a Tensor with shape [batch, heads, length, depth_k]
+    v: a Tensor with shape [batch, heads, length, depth_v]
+    lut: a pair (kv_block_indices, kv_block_mask) of Tensors with shape
+      [num_blocks, blocks_per_query], e.g. from block_sparse_local_lut.
+      num_blocks must equal ceil(length / block_size).
+    block_size: an integer
+    mask_right: a boolean, whether a query position may not see greater
+      memory positions.
+    filter_width: an optional integer. If set, a query position may only see
+      memory positions at most filter_width to the left and right of its
+      block, even if lut lists blocks that reach further.
+    name: an optional string
+
+  Returns:
+    a Tensor of shape [batch, heads, length, depth_v]
+  """
+  with tf.variable_scope(
+      name, default_name="block_sparse_attention", values=[q, k, v]):
+    kv_block_indices, kv_block_mask = lut
+    batch, heads, length, depth_k = common_layers.shape_list(q)
+    depth_v = common_layers.shape_list(v)[-1]
+    padding = [[0, 0], [0, 0], [0, -length % block_size], [0, 0]]
+    q = tf.pad(q, padding)
+    k = tf.pad(k, padding)
+    v = tf.pad(v, padding)
+    num_blocks, blocks_per_query = common_layers.shape_list(kv_block_indices)
+    # [batch, heads, num_blocks, block_size, depth]
+    q = tf.reshape(q, [batch, heads, num_blocks, block_size, depth_k])
+    k = tf.reshape(k, [batch, heads, num_blocks, block_size, depth_k])
+    v = tf.reshape(v, [batch, heads, num_blocks, block_size, depth_v])
+    # [batch, heads, num_blocks, blocks_per_query * block_size, depth]
+    local_length = blocks_per_query * block_size
+    k = tf.reshape(tf.gather(k, kv_block_indices, axis=2),
+                   [batch, heads, num_blocks, local_length, depth_k])
+    v = tf.reshape(tf.gather(v, kv_block_indices, axis=2),
+                   [batch, heads, num_blocks, local_length, depth_v])
+
+    # Positions of the queries and of the gathered memory in the sequence.
+    # [num_blocks, block_size, 1]
+    q_pos = tf.reshape(tf.range(num_blocks * block_size),
+                       [num_blocks, block_size, 1])
+    # [num_blocks, 1, local_length]
+    k_pos = tf.reshape(
+        tf.expand_dims(kv_block_indices * block_size, 2) + tf.range(
+            block_size), [num_blocks, 1, local_length])
+    k_mask = tf.reshape(
+        tf.tile(tf.expand_dims(kv_block_mask, 2), [1, 1, block_size]),
+        [num_blocks, 1, local_length])
+    visible = tf.logical_and(k_mask, k_pos < length)
+    if mask_right:
+      visible = tf.logical_and(visible, k_pos <= q_pos)
+    if filter_width is not None:
+      # [num_blocks, 1, 1]
+      block_start = tf.reshape(tf.range(num_blocks) * block_size,
+                               [num_blocks, 1, 1])
+      visible = tf.logical_and(
+          visible,
+          tf.logical_and(k_pos >= block_start - filter_width,
+                         k_pos < block_start + block_size + filter_width))
+    # [num_blocks, block_size or 1, local_length]
+    bias = (1.0 - tf.cast(visible, tf.float32)) * large_compatible_negative(
+        q.dtype)
+
+    logits = tf.matmul(q, k, transpose_b=True)
+    logits += common_layers.cast_like(bias, logits)
+    weights = tf.nn.softmax(logits, name="attention_weights")
+    output = tf.matmul(weights, v)
+    output = tf.reshape(output, [batch, heads, num_blocks * block_size,
+                                 depth_v])
+    output = output[:, :, :length, :]
+    output.set_shape([None if isinstance(dim, tf.Tensor) else dim for dim in
+                      (batch, heads, length, depth_v)])
+    return output
+
+
+def block_sparse_local_attention_1d(q, k, v, block_length=128,
+                                    filter_width=0, mask_right=False,
+                                    name=None):
+  """Local 1d self-attention computed with block_sparse_attention.
+
+  Attention for a given query position can see all memory positions in the
+  corresponding block and filter_width many positions to the left and right
+  of the block, as in local_attention_1d. The lookup table covers
+  ceil(filter_width / block_length) blocks on each side and the positions
+  beyond filter_width are masked out. If mask_right is True, only the
+  previous block is visible to the left (as in masked_local_attention_1d) and
+  a query position cannot see greater memory positions.
+
+  Args:
+    q: a Tensor with shape [batch, heads, length, depth_k]
+    k: a Tensor with shape [batch, heads, length, depth_k]
+    v: a Tensor with shape [batch, heads, length, depth_v]
+    block_length: an integer
+    filter_width: an integer indicating how much to look left and right of the
+      block. Ignored if mask_right is True.
+    mask_right: a boolean
+    name: an optional string
+
+  Returns:
+    a Tensor of shape [batch, heads, length, depth_v]
+  """
+  length = common_layers.shape_list(q)[2]
+  if isinstance(length, int):
+    block_length = min(block_length, length)
+    num_blocks = -(-length // block_length)
+  else:
+    num_blocks = (length + block_length - 1) // block_length
+  if mask_right:
+    blocks_left, blocks_right = 1, 0
+  else:
+    blocks_left = blocks_right = -(-filter_width // block_length)
+  lut = block_sparse_local_lut(num_blocks, blocks_left, blocks_right)
+  return block_sparse_attention(
+      q, k, v, lut, block_length, mask_right=mask_right,
+      filter_width=None if mask_right else filter_width,
+      name=name or "block_sparse_local_attention_1d")
+
+
 def reshape_by_blocks(x, x_shape, memory_block_size):
   """Reshapes input by splitting its length over blocks of memory_block_size.
 
@@ -4522,6 +5237,7 @@ def multihead_attention(query_antecedent,
                         area_key_mode="mean",
                         area_value_mode="sum",
                         training=True,
+                        recompute_attention=False,
                         **kwargs):
   """Multihead scaled-dot-product attention with input/output transformations.
 
@@ -4535,8 +5251,10 @@ def multihead_attention(query_antecedent,
     num_heads: an integer dividing total_key_depth and total_value_depth
     dropout_rate: a floating point number
     attention_type: a string, either "dot_product", "dot_product_relative",
-                    "local_mask_right", "local_unmasked", "masked_dilated_1d",
-                    "unmasked_dilated_1d", graph, or any attention function
+                    "local_mask_right", "local_unmasked",
+                    "local_block_sparse", "local_block_sparse_mask_right",
+                    "masked_dilated_1d", "unmasked_dilated_1d", graph, or any
+                    attention function
                     with the signature (query, key, value, **kwargs)
     max_relative_position: Maximum distance between inputs to generate
                            unique relation embeddings for. Only relevant
@@ -4591,6 +5309,9 @@ def multihead_attention(query_antecedent,
     area_value_mode: the mode for computing area values, which can be either
       "mean", or "sum".
     training: indicating if it is in the training mode.
+    recompute_attention: if True, recompute the "dot_product" attention
+      (softmax(QK^T)V) during the backward pass instead of storing its
+      activations. The input/output transformations are not recomputed.
     **kwargs (dict): Parameters for the attention function.
 
   Caching:
@@ -4685,11 +5406,15 @@ def multihead_attention(query_antecedent,
           v = cache["v"] = tf.concat([cache["v"], v], axis=2)
         else:
           tmp_k = tf.transpose(cache["k"], perm=[2, 0, 1, 3])
-          tmp_k = tf.add(tmp_k, tf.scatter_nd([[decode_loop_step]], tf.expand_dims(tf.squeeze(k, axis=2), 0), tmp_k.shape))
+          tmp_k = tf.tensor_scatter_nd_add(
+              tmp_k, [[decode_loop_step]],
+              tf.expand_dims(tf.squeeze(k, axis=2), 0))
           k = cache["k"] = tf.transpose(tmp_k, perm=[1, 2, 0, 3])
 
           tmp_v = tf.transpose(cache["v"], perm=[2, 0, 1, 3])
-          tmp_v = tf.add(tmp_v, tf.scatter_nd([[decode_loop_step]], tf.expand_dims(tf.squeeze(v, axis=2), 0), tmp_v.shape))
+          tmp_v = tf.tensor_scatter_nd_add(
+              tmp_v, [[decode_loop_step]],
+              tf.expand_dims(tf.squeeze(v, axis=2), 0))
           v = cache["v"] = tf.transpose(tmp_v, perm=[1, 2, 0, 3])
 
     q = split_heads(q, num_heads)
@@ -4719,14 +5444,28 @@ def multihead_attention(query_antecedent,
             area_value_mode=area_value_mode,
             training=training)
       else:
-        x = dot_product_attention(
-            q, k, v, bias, dropout_rate, image_shapes,
+        attention_fn = functools.partial(
+            dot_product_attention,
+            dropout_rate=dropout_rate,
+            image_shapes=image_shapes,
             save_weights_to=save_weights_to,
             make_image_summary=make_image_summary,
             dropout_broadcast_dims=dropout_broadcast_dims,
             activation_dtype=kwargs.get("activation_dtype"),
             hard_attention_k=hard_attention_k,
-            gumbel_noise_weight=gumbel_noise_weight)
+            gumbel_noise_weight=gumbel_noise_weight,
+            qkv_compute_dtype=kwargs.get("qkv_compute_dtype"),
+            softmax_dtype=kwargs.get("softmax_dtype"),
+            kv_block_size=kwargs.get("kv_block_size"),
+            causal=kwargs.get("causal", False))
+        if recompute_attention:
+          # recompute_grad only accepts Tensors, so a None bias is not passed.
+          bias_args = [] if bias is None else [bias]
+          x = common_layers.recompute_grad(
+              lambda q, k, v, *bias: attention_fn(q, k, v, *(bias or [None])))(
+                  q, k, v, *bias_args)
+        else:
+          x = attention_fn(q, k, v, bias)
     elif attention_type == "dot_product_relative":
       x = dot_product_attention_relative(
           q,
@@ -4794,6 +5533,12 @@ def multihead_attention(query_antecedent,
     elif attention_type == "local_unmasked":
       x = local_attention_1d(
           q, k, v, block_length=block_length, filter_width=block_width)
+    elif attention_type == "local_block_sparse":
+      x = block_sparse_local_attention_1d(
+          q, k, v, block_length=block_length, filter_width=block_width)
+    elif attention_type == "local_block_sparse_mask_right":
+      x = block_sparse_local_attention_1d(
+          q, k, v, block_length=block_length, mask_right=True)
     elif attention_type == "masked_dilated_1d":
       x = masked_dilated_self_attention_1d(q, k, v, block_length, block_width,
                                            gap_size, num_memory_blocks)
@@ -5471,8 +6216,42 @@ def expert_dot_product(q, k, v, info_q, info_k):
   return v_out
 
 
+class _BucketDispatcher(object):
+  """SparseDispatcher equivalent for one-hot gates given as bucket ids.
+
+  Every element goes to exactly one bucket with a gate of 1, so the dispatch
+  order is a stable sort by bucket id and no [length, nb_buckets] gate matrix
+  needs to be built.
+  """
+
+  def __init__(self, nb_buckets, bucket_ids):
+    """Create a _BucketDispatcher.
+
+    Args:
+      nb_buckets (int): Number of buckets
+      bucket_ids (tf.Tensor): int32 of shape [length]
+    """
+    self._nb_buckets = nb_buckets
+    self._length = tf.shape(bucket_ids)[0]
+    # Same ordering than SparseDispatcher: by bucket, then by position
+    self._batch_index = tf.argsort(bucket_ids, stable=True)
+    self._part_sizes_tensor = tf.math.bincount(
+        bucket_ids, minlength=nb_buckets, maxlength=nb_buckets)
+
+  def dispatch(self, inp):
+    """Split inp [length, ...] into one Tensor per bucket."""
+    inp = tf.gather(inp, self._batch_index)
+    return tf.split(inp, self._part_sizes_tensor, 0, num=self._nb_buckets)
+
+  def combine(self, expert_out):
+    """Restore the bucket outputs to their original positions."""
+    stitched = common_layers.convert_gradient_to_tensor(
+        tf.concat(expert_out, 0))
+    return tf.unsorted_segment_sum(stitched, self._batch_index, self._length)
+
+
 @expert_utils.add_name_scope()
-def dot_product_single_head(q, k, v, gates_q, gates_k, bi):
+def dot_product_single_head(q, k, v, gates_q, gates_k, bi, nb_buckets=None):
   """Perform a dot product attention on a single sequence on a single head.
 
   This function dispatch the q, k, v and loop over the buckets to compute the
@@ -5482,18 +6261,24 @@ def dot_product_single_head(q, k, v, gates_q, gates_k, bi):
     q (tf.Tensor): [length_q, depth_q]
     k (tf.Tensor): [length_k, depth_q]
     v (tf.Tensor): [length_k, depth_v]
-    gates_q (tf.Tensor): One-hot vector of shape [length_q, nb_buckets]
-    gates_k (tf.Tensor): One-hot vector of shape [length_k, nb_buckets]
+    gates_q (tf.Tensor): One-hot vector of shape [length_q, nb_buckets], or
+      int32 bucket ids of shape [length_q] if nb_buckets is given
+    gates_k (tf.Tensor): One-hot vector of shape [length_k, nb_buckets], or
+      int32 bucket ids of shape [length_k] if nb_buckets is given
     bi (BatchInfo): Contains the batch coordinates and sequence order
+    nb_buckets (int): If set, the gates are bucket ids instead of one-hot
 
   Returns:
     tf.Tensor: [length_q, depth_v]
   """
 
-  nb_buckets = gates_q.get_shape().as_list()[-1]
-
-  q_dispatcher = expert_utils.SparseDispatcher(nb_buckets, gates_q)
-  k_dispatcher = expert_utils.SparseDispatcher(nb_buckets, gates_k)
+  if nb_buckets is None:
+    nb_buckets = gates_q.get_shape().as_list()[-1]
+    q_dispatcher = expert_utils.SparseDispatcher(nb_buckets, gates_q)
+    k_dispatcher = expert_utils.SparseDispatcher(nb_buckets, gates_k)
+  else:
+    q_dispatcher = _BucketDispatcher(nb_buckets, gates_q)
+    k_dispatcher = _BucketDispatcher(nb_buckets, gates_k)
 
   def eventually_dispatch(dispatcher, value):
     if value is not None:
@@ -5634,15 +6419,18 @@ def sparse_dot_product_attention(q, k, v, bi, use_map_fn, experts_params):
     lhs_gating = LshGating(
         depth=single_q.get_shape().as_list()[-1], **experts_params)
 
-    list_gates_q.append(lhs_gating.get_gates(single_q))
-    list_gates_k.append(lhs_gating.get_gates(single_k))
+    # Bucket ids rather than one-hot: the dispatch only needs the indices
+    list_gates_q.append(lhs_gating.get_gate_indices(single_q))
+    list_gates_k.append(lhs_gating.get_gate_indices(single_k))
+  nb_buckets = lhs_gating.nb_buckets
 
   gates_q = tf.stack(list_gates_q)
   gates_k = tf.stack(list_gates_k)
 
   # Process each head separately.
   v_out = map_fn_switch(
-      lambda args: dot_product_single_head(bi=bi, *args),
+      lambda args: dot_product_single_head(
+          bi=bi, nb_buckets=nb_buckets, *args),
       elems=(q, k, v, gates_q, gates_k),
       dtype=(tf.float32),
       parallel_iterations=2,
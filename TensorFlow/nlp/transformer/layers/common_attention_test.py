@@ -0,0 +1,144 @@
+# coding=utf-8
+# Copyright 2021 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for common_attention."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from TensorFlow.nlp.transformer.layers import common_attention
+import tensorflow.compat.v1 as tf
+
+
+class CommonAttentionTest(tf.test.TestCase):
+
+  def testMultiheadAttentionFixedLengthCacheUpdate(self):
+    batch, length, depth, num_heads = 2, 5, 8, 2
+    decode_loop_step = 3
+    x = np.random.rand(batch, 1, depth).astype(np.float32)
+    cache_k = np.random.rand(batch, num_heads, length,
+                             depth // num_heads).astype(np.float32)
+    cache_v = np.random.rand(batch, num_heads, length,
+                             depth // num_heads).astype(np.float32)
+    with tf.Graph().as_default():
+      cache = {"k": tf.constant(cache_k), "v": tf.constant(cache_v)}
+      common_attention.multihead_attention(
+          tf.constant(x), None, tf.zeros([1, 1, 1, length]),
+          total_key_depth=depth, total_value_depth=depth, output_depth=depth,
+          num_heads=num_heads, dropout_rate=0.0, cache=cache,
+          decode_loop_step=decode_loop_step, name="self_attention")
+      kernels = {v.op.name.split("/")[-2]: v for v in tf.global_variables()}
+
+      def _expected(old_cache, kernel):
+        # Previous implementation: add a scattered dense update to the cache.
+        new = common_attention.split_heads(
+            tf.tensordot(tf.constant(x), kernel, 1), num_heads)
+        tmp = tf.transpose(tf.constant(old_cache), perm=[2, 0, 1, 3])
+        tmp = tf.add(tmp, tf.scatter_nd(
+            [[decode_loop_step]], tf.expand_dims(tf.squeeze(new, axis=2), 0),
+            tmp.shape))
+        return tf.transpose(tmp, perm=[1, 2, 0, 3])
+
+      expected_k = _expected(cache_k, kernels["k"])
+      expected_v = _expected(cache_v, kernels["v"])
+      with self.session() as session:
+        session.run(tf.global_variables_initializer())
+        res = session.run(
+            [cache["k"], cache["v"], expected_k, expected_v])
+    self.assertAllClose(res[2], res[0])
+    self.assertAllClose(res[3], res[1])
+    # Only the decode_loop_step slot changed.
+    self.assertAllClose(np.delete(cache_k, decode_loop_step, axis=2),
+                        np.delete(res[0], decode_loop_step, axis=2))
+
+  def testBlockSparseLocalAttention1DMatchesLocalAttention1D(self):
+    batch, heads, length, depth = 2, 3, 20, 5
+    q = np.random.rand(batch, heads, length, depth).astype(np.float32)
+    k = np.random.rand(batch, heads, length, depth).astype(np.float32)
+    v = np.random.rand(batch, heads, length, depth).astype(np.float32)
+    # filter_width is not a multiple of block_length, as with the default
+    # attention_loc_block_length / attention_loc_block_width hparams.
+    for block_length, filter_width in [(4, 3), (4, 6), (8, 13)]:
+      with tf.Graph().as_default():
+        q_t, k_t, v_t = tf.constant(q), tf.constant(k), tf.constant(v)
+        expected = common_attention.local_attention_1d(
+            q_t, k_t, v_t, block_length=block_length,
+            filter_width=filter_width)
+        actual = common_attention.block_sparse_local_attention_1d(
+            q_t, k_t, v_t, block_length=block_length,
+            filter_width=filter_width)
+        with self.session() as session:
+          res = session.run([expected, actual])
+      self.assertAllClose(res[0], res[1])
+
+  def testDotProductAttentionBlockwiseDynamicBias(self):
+    q = np.random.rand(2, 3, 4, 5).astype(np.float32)
+    k = np.random.rand(2, 3, 10, 5).astype(np.float32)
+    v = np.random.rand(2, 3, 10, 6).astype(np.float32)
+    bias = np.random.rand(2, 1, 4, 10).astype(np.float32)
+
+    # The memory dimension of the bias is only known when the function runs.
+    @tf.function(autograph=False, input_signature=[
+        tf.TensorSpec([None, None, None, None], tf.float32)])
+    def attention(bias_t):
+      expected = common_attention.dot_product_attention(
+          tf.constant(q), tf.constant(k), tf.constant(v), bias_t,
+          make_image_summary=False)
+      actual = common_attention.dot_product_attention(
+          tf.constant(q), tf.constant(k), tf.constant(v), bias_t,
+          make_image_summary=False, kv_block_size=4)
+      return expected, actual
+
+    expected, actual = attention(tf.constant(bias))
+    self.assertAllClose(expected, actual)
+
+  def testGroupedAttentionMultiheadSelfAttentionVariableNames(self):
+    x = np.random.rand(2, 16, 8).astype(np.float32)
+
+    def _variables(self_attention):
+      with tf.Graph().as_default():
+        query = tf.constant(x)
+        memory = query if self_attention else tf.constant(x)
+        common_attention.grouped_attention_multihead(
+            query, memory, total_key_depth=8, total_value_depth=8,
+            output_depth=8, num_heads=2, num_groups=3,
+            make_image_summary=False, name="ga")
+        return [(v.op.name, v.shape.as_list()) for v in tf.global_variables()]
+
+    self_attention_variables = _variables(self_attention=True)
+    self.assertIn(("ga/q_pred/kernel", [8, 6]), self_attention_variables)
+    self.assertIn(("ga/m_pred/kernel", [8, 6]), self_attention_variables)
+    self.assertEqual(_variables(self_attention=False), self_attention_variables)
+
+  def testAddPositionalEmbeddingSmallIntPositions(self):
+    x = np.random.rand(2, 4, 5).astype(np.float32)
+    positions = np.array([[0, 1, 2, 3], [3, 2, 1, 0]])
+    for dtype in [tf.int8, tf.uint8, tf.int32, tf.int64, tf.float32]:
+      with tf.Graph().as_default():
+        y = common_attention.add_positional_embedding(
+            tf.constant(x), max_length=4, name="pos",
+            positions=tf.constant(positions, dtype=dtype))
+        var = tf.global_variables()[0]
+        with self.session() as session:
+          session.run(tf.global_variables_initializer())
+          res, var_value = session.run([y, var])
+      self.assertAllClose(x + var_value[positions], res)
+
+
+if __name__ == "__main__":
+  tf.test.main()